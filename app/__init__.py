@@ -6,12 +6,21 @@ from app.routes.shop import shop_bp
 from app.routes.product import product_bp
 from app.routes.upload import upload_bp
 from app.routes.analytics import analytics_bp
-from app.routes.notification import notification_bp
+from app.routes.notification import notification_bp, stream_token_allowed
 from app.routes.transaction import transaction_bp
+from app.routes.metrics import metrics_bp
 from app.routes.ai import prophet_bp
 from app.db import me
+from app import instrumentation, logs, metrics
+from app.serialization import ORJSONProvider
+from app.revocation import is_token_revoked
+from app.jobs import reconcile_inventory_command, reconcile_notifications_command, sweep_expired_command
+from app.change_stream import watch_changes_command
+from app.profiling import profile_token_command, profile_report_command
+import logging
 import os
 from flask_jwt_extended import JWTManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import timedelta
 import cloudinary
 import cloudinary.uploader
@@ -19,10 +28,12 @@ from cloudinary.utils import cloudinary_url
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
 
 def create_app():
     app = Flask(__name__)
+    app.json = ORJSONProvider(app)
 
      # Configuration       
     cloudinary.config( 
@@ -37,16 +48,29 @@ def create_app():
     app.config["JWT_SECRET_KEY"] = os.getenv("secret_key") 
     app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=8)
     app.config["JWT_REFRESH_TOKEN_EXPIRES"] = timedelta(days=30)
+    # Reverse proxies in front of the app (1 on Render); their X-Forwarded-For
+    # entries become request.remote_addr, which per-IP rate limits key on
+    app.config["TRUSTED_PROXY_COUNT"] = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+    if app.config["TRUSTED_PROXY_COUNT"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXY_COUNT"])
 
     jwt = JWTManager(app)
+    # Bloom-filtered: only possibly-revoked tokens cost a database lookup
+    jwt.token_in_blocklist_loader(is_token_revoked)
+    # Notification stream tokens (sent in URLs) work on no other route
+    jwt.token_verification_loader(stream_token_allowed)
+
+    # JSON logs written by a background thread, tagged with request ids
+    logs.init_app(app)
+    # Per-request query counts/timings: Server-Timing header and a log line
+    instrumentation.init_app(app)
+    # Prometheus request histograms and in-flight gauges, scraped from /metrics
+    metrics.init_app(app)
 
     if not app.config["SECRET_KEY"]:
         raise RuntimeError("SECRET_KEY is missing. Check your .env file!")
 
-    try:
-        print("Database connected successfully")
-    except Exception as e:
-        print(f"Error connecting to the database: {e}")
+    logger.info("Application created", extra={'database': os.getenv("mongodb_database_name")})
 
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(user_bp)
@@ -56,5 +80,12 @@ def create_app():
     app.register_blueprint(analytics_bp, url_prefix='/analytics')
     app.register_blueprint(notification_bp)
     app.register_blueprint(transaction_bp)
+    app.register_blueprint(metrics_bp)
+    app.cli.add_command(reconcile_inventory_command)
+    app.cli.add_command(reconcile_notifications_command)
+    app.cli.add_command(sweep_expired_command)
+    app.cli.add_command(watch_changes_command)
+    app.cli.add_command(profile_token_command)
+    app.cli.add_command(profile_report_command)
     # app.register_blueprint(prophet_bp)
     return app
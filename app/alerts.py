@@ -0,0 +1,62 @@
+"""
+Low-stock alerts.
+
+Product.stock_changed calls notify_low_stock when a stock write moves a
+product from above its threshold to at/below it. The check runs on the
+result of the atomic update, so the checkout path pays nothing unless the
+threshold is actually crossed.
+"""
+import os
+import threading
+from datetime import datetime, timedelta
+
+from mongoengine.queryset.visitor import Q
+
+from app.models import Notification, Product, Shop, User, ref_id
+from app.utils import send_email
+
+# A burst of sales around the threshold produces at most one alert per window
+ALERT_DEBOUNCE = timedelta(seconds=int(os.getenv("LOW_STOCK_ALERT_DEBOUNCE_SECONDS", "900")))
+EMAIL_ALERTS = os.getenv("LOW_STOCK_EMAIL_ALERTS", "false").lower() == "true"
+
+
+def claim_alert(product_id, now=None):
+    """Atomically record an alert for the product unless one was sent within the debounce window.
+
+    The conditional update is the debounce: across requests and workers only
+    one caller wins it.
+    """
+    now = now or datetime.utcnow()
+    not_recent = Q(low_stock_alerted_at=None) | Q(low_stock_alerted_at__lte=now - ALERT_DEBOUNCE)
+    return Product.objects(Q(id=product_id) & not_recent).update_one(set__low_stock_alerted_at=now) == 1
+
+
+def notify_low_stock(product_id, shop_id, product_name, quantity, threshold):
+    """Notify the shop owner that a product fell to or below its threshold"""
+    if not claim_alert(product_id):
+        return None
+
+    shop = Shop.objects(id=shop_id).only('name', 'owner').first()
+    if not shop:
+        return None
+
+    owner_id = ref_id(shop._data.get('owner'))
+    message = f"{product_name} is low on stock at {shop.name}: {quantity} left (threshold {threshold})"
+    notification = Notification(
+        recipient=owner_id,
+        shop=shop,
+        type='low_stock',
+        message=message
+    )
+    notification.save()
+
+    if EMAIL_ALERTS:
+        owner = User.objects(id=owner_id).only('email').first()
+        if owner:
+            # SMTP is slow; keep it off the request that made the sale
+            threading.Thread(
+                target=send_email,
+                args=(owner.email, f"Low stock: {product_name}", message),
+                daemon=True
+            ).start()
+    return notification
@@ -0,0 +1,44 @@
+"""
+In-process wake-ups for notification listeners.
+
+Notification.save publishes the recipient's id here so SSE streams and
+long-polls served by the same worker wake immediately. Listeners also
+re-check the database every few seconds (an indexed, usually empty query),
+which picks up notifications created by other workers or processes.
+"""
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class NotificationBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = defaultdict(set)
+
+    def publish(self, recipient_id):
+        with self._lock:
+            listeners = list(self._listeners.get(recipient_id, ()))
+        for event in listeners:
+            event.set()
+
+    @contextmanager
+    def listen(self, recipient_id):
+        """Yield an Event that is set whenever a notification is published for recipient_id.
+
+        Register before querying and clear() before each query, so a
+        notification published in between is never missed.
+        """
+        event = threading.Event()
+        with self._lock:
+            self._listeners[recipient_id].add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                self._listeners[recipient_id].discard(event)
+                if not self._listeners[recipient_id]:
+                    del self._listeners[recipient_id]
+
+
+broker = NotificationBroker()
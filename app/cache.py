@@ -0,0 +1,104 @@
+"""
+Response cache for per-shop dashboard data.
+
+Keys embed the shop's `data_version`, which every sale, restock, item and
+product write bumps, so a write makes older entries unreachable instead of
+having to find and delete them. Stale entries simply age out of the LRU or
+expire via the Redis TTL.
+"""
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # Redis is optional, the in-process cache is the default
+    redis = None
+
+
+DEFAULT_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "60"))
+DEFAULT_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL"""
+
+    def __init__(self, maxsize=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    """Cache backed by any Redis-compatible client (redis-py, fakeredis, ...).
+
+    Values are stored as JSON. Backend errors are treated as misses so a
+    Redis outage degrades to recomputing instead of failing requests.
+    """
+
+    def __init__(self, client, ttl=DEFAULT_TTL, prefix="stocksmart:cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except Exception:
+            return None
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+        except Exception:
+            pass
+
+
+def make_key(endpoint, shop_id, version, params=None):
+    query = "&".join(f"{k}={v}" for k, v in sorted((params or {}).items()))
+    return f"{endpoint}:{shop_id}:{version}:{query}"
+
+
+def get_redis_client():
+    """Return a Redis client for REDIS_URL, or None when not configured"""
+    url = os.getenv("REDIS_URL")
+    if not url or redis is None:
+        return None
+    return redis.Redis.from_url(url)
+
+
+def _build_response_cache():
+    client = get_redis_client()
+    if client is not None:
+        return RedisCache(client)
+    return LRUCache()
+
+
+response_cache = _build_response_cache()
@@ -0,0 +1,187 @@
+"""
+Change-stream worker for the derived side effects of stock and sales writes.
+
+With ASYNC_SIDE_EFFECTS=true on the web workers, requests only write the
+primary data (item documents, product quantities, transactions) and this
+process, tailing the `items`, `products` and `transactions` collections,
+catches everything else up:
+
+    items         -> recount the quantity of serialized products
+    products      -> recompute the shop's stock counters when a product is
+                     added, removed or its quantity/price/threshold changed,
+                     bump its data_version (invalidating cached dashboards)
+                     and raise low-stock alerts when is_low_stock flips to
+                     true; other edits only bump data_version
+    transactions  -> bump the shop's data_version
+
+Every step is idempotent (counts are recomputed, alerts are debounced), so
+events may be replayed safely. The resume token is persisted to a local file
+after each processed batch, and a restarted worker continues from it.
+
+    flask --app run watch-changes [--batch-size 500]
+
+Change streams need a replica set; a single-node one is enough locally:
+
+    mongod --replSet rs0 --dbpath /tmp/rs0 && mongosh --eval "rs.initiate()"
+"""
+import logging
+import os
+import tempfile
+
+import click
+from bson import json_util
+from pymongo.errors import OperationFailure
+
+from app.jobs import STOCK_COUNTERS, compute_stock_counters, reconcile_low_stock_flags, reconcile_stock_counters
+from app.models import Item, Product, Shop, BUMP_VERSION, LOW_STOCK_EXPRESSIONS
+
+logger = logging.getLogger(__name__)
+
+WATCHED_COLLECTIONS = ('items', 'products', 'transactions')
+TOKEN_FILE = os.getenv("CHANGE_STREAM_TOKEN_FILE", ".change_stream_token.json")
+
+# Product fields the shop's stock counters are computed from
+COUNTER_FIELDS = {'quantity', 'price', 'threshold'}
+# Bookkeeping written alongside other changes, or by the alert debounce
+# claim; an update touching only these changes nothing a dashboard shows
+BOOKKEEPING_FIELDS = {'version', 'low_stock_alerted_at'}
+
+# Server error codes meaning the resume token is no longer in the oplog
+HISTORY_LOST_CODES = (136, 280, 286)
+
+
+def load_resume_token(path=TOKEN_FILE):
+    try:
+        with open(path) as f:
+            return json_util.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def save_resume_token(token, path=TOKEN_FILE):
+    # Write-then-rename so a crash never leaves a truncated token behind
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+        f.write(json_util.dumps(token))
+    os.replace(f.name, path)
+
+
+def enable_pre_images(db):
+    """Ask the server to keep pre-images so delete events carry the deleted document (MongoDB 6.0+)"""
+    for name in ('items', 'products'):
+        try:
+            db.command('collMod', name, changeStreamPreAndPostImages={'enabled': True})
+        except OperationFailure as e:
+            logger.warning("Pre-images unavailable for %s (%s); deletes will need `flask reconcile-inventory`", name, e)
+
+
+def recount_item_quantities(product_ids):
+    """Set each serialized product's quantity to its number of items, refreshing its low-stock fields"""
+    for product_id in product_ids:
+        count = Item.objects(product=product_id).count()
+        Product._get_collection().update_one(
+            {'_id': product_id, 'isSerialized': True},
+            [{'$set': {'quantity': count, **BUMP_VERSION}}, {'$set': LOW_STOCK_EXPRESSIONS}]
+        )
+
+
+def refresh_shops(recount_ids, bump_ids):
+    """Recompute stock counters for recount_ids and bump data_version for every shop touched"""
+    counters = compute_stock_counters(recount_ids) if recount_ids else {}
+    for shop_id in recount_ids:
+        values = counters.get(shop_id, dict.fromkeys(STOCK_COUNTERS, 0))
+        Shop.objects(id=shop_id).update_one(
+            inc__data_version=1, **{f'set__{field}': values[field] for field in STOCK_COUNTERS}
+        )
+    for shop_id in bump_ids - recount_ids:
+        Shop.bump_version(shop_id)
+
+
+def changed_fields(change):
+    description = change.get('updateDescription') or {}
+    return set(description.get('updatedFields', {})) | set(description.get('removedFields', []))
+
+
+def process_batch(changes):
+    """Apply the side effects of a batch of change events, deduplicated per product/shop"""
+    from app.alerts import notify_low_stock
+
+    products_to_recount, shops_to_recount, shops_to_bump, alerts = set(), set(), set(), {}
+    for change in changes:
+        collection = change['ns']['coll']
+        doc = change.get('fullDocument') or change.get('fullDocumentBeforeChange') or {}
+        if not doc and change['operationType'] in ('delete', 'update', 'replace'):
+            logger.warning("No document for %s on %s %s", change['operationType'], collection, change['documentKey'])
+
+        if collection == 'items':
+            if doc.get('product'):
+                products_to_recount.add(doc['product'])
+        elif collection == 'products':
+            if doc.get('shop'):
+                if change['operationType'] != 'update' or changed_fields(change) & COUNTER_FIELDS:
+                    shops_to_recount.add(doc['shop'])
+                elif changed_fields(change) - BOOKKEEPING_FIELDS:
+                    shops_to_bump.add(doc['shop'])
+            updated = change.get('updateDescription', {}).get('updatedFields', {})
+            if updated.get('is_low_stock') is True and doc.get('is_low_stock'):
+                alerts[doc['_id']] = doc
+        elif collection == 'transactions':
+            if doc.get('shop'):
+                shops_to_bump.add(doc['shop'])
+
+    # Recounted quantities come back as product events in a later batch,
+    # which is where their shops are refreshed
+    recount_item_quantities(products_to_recount)
+    refresh_shops(shops_to_recount, shops_to_bump)
+    for doc in alerts.values():
+        notify_low_stock(doc['_id'], doc.get('shop'), doc.get('name'), doc.get('quantity', 0), doc.get('threshold', 0))
+
+
+def watch(batch_size=500, token_file=TOKEN_FILE):
+    """Tail the watched collections forever, processing events in batches"""
+    db = Product._get_db()
+    enable_pre_images(db)
+    pipeline = [{'$match': {'ns.coll': {'$in': list(WATCHED_COLLECTIONS)}}}]
+    token = load_resume_token(token_file)
+
+    while True:
+        try:
+            with db.watch(
+                pipeline,
+                resume_after=token,
+                full_document='updateLookup',
+                full_document_before_change='whenAvailable',
+                max_await_time_ms=1000
+            ) as stream:
+                logger.info("Watching %s (%s)", ", ".join(WATCHED_COLLECTIONS), "resumed" if token else "from now")
+                while stream.alive:
+                    batch = []
+                    while len(batch) < batch_size:
+                        change = stream.try_next()
+                        if change is None:
+                            break
+                        batch.append(change)
+                    if batch:
+                        process_batch(batch)
+                        logger.info("Processed %d change(s)", len(batch))
+                    # The token also advances while idle, so restarts skip quiet periods
+                    if stream.resume_token and stream.resume_token != token:
+                        token = stream.resume_token
+                        save_resume_token(token, token_file)
+        except OperationFailure as e:
+            if e.code not in HISTORY_LOST_CODES or token is None:
+                raise
+            # Down longer than the oplog window: rebuild derived state from scratch and start over
+            logger.warning("Resume token expired (%s); reconciling all shops", e)
+            token = None
+            reconcile_stock_counters()
+            reconcile_low_stock_flags()
+
+
+@click.command('watch-changes')
+@click.option('--batch-size', default=500, show_default=True, help='Maximum events applied per batch')
+@click.option('--token-file', default=TOKEN_FILE, show_default=True, help='Where the resume token is persisted')
+def watch_changes_command(batch_size, token_file):
+    """Run the change-stream worker for stock and sales side effects."""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    watch(batch_size, token_file)
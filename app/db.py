@@ -1,11 +1,57 @@
 # from pymongo import MongoClient
 import os
+from functools import wraps
 import mongoengine as me
+from mongoengine.connection import get_db
+from mongoengine.queryset import QuerySet
+from flask import g, has_app_context
+from pymongo.read_preferences import SecondaryPreferred
 from dotenv import load_dotenv
+from app.instrumentation import query_tracker
+from app.metrics import pool_metrics
 
 load_dotenv()
 
+# Alias for the staleness-tolerant read connection used by dashboards/reporting
+READ_REPLICA_ALIAS = "read_replica"
+
+# pymongo refuses max staleness values below 90 seconds
+MAX_STALENESS_SECONDS = max(int(os.getenv("MONGO_MAX_STALENESS_SECONDS", "120")), 90)
+
+me.connect(
+    db=os.getenv("mongodb_database_name"),
+    host=os.getenv("MONGO_URI"),
+    event_listeners=[query_tracker, pool_metrics]
+    )
+
 me.connect(
+    alias=READ_REPLICA_ALIAS,
     db=os.getenv("mongodb_database_name"),
-    host=os.getenv("MONGO_URI")
+    host=os.getenv("MONGO_READ_URI") or os.getenv("MONGO_URI"),
+    read_preference=SecondaryPreferred(max_staleness=MAX_STALENESS_SECONDS),
+    event_listeners=[query_tracker, pool_metrics]
     )
+
+
+def replica_reads(view):
+    """Route decorator: queries made through `reads()` go to a secondary"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_alias = READ_REPLICA_ALIAS
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def reads(document):
+    """Return a queryset for `document` bound to the current route's read connection.
+
+    Routes decorated with `replica_reads` get a queryset on the read replica
+    alias, everything else keeps using the primary (`document.objects`).
+    """
+    alias = g.get("read_alias") if has_app_context() else None
+    if not alias:
+        return document.objects
+    # Build the queryset on the replica collection directly instead of using
+    # switch_db, which temporarily mutates the document class for every thread
+    collection = get_db(alias)[document._get_collection_name()]
+    return document._meta.get("queryset_class", QuerySet)(document, collection)
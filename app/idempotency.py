@@ -0,0 +1,62 @@
+"""
+Idempotency-Key support for write routes that clients retry.
+
+A request that carries an `Idempotency-Key` header claims the key for its
+caller and route with a unique insert. It runs, and its outcome is stored
+in idempotency_keys, which a TTL index expires after IDEMPOTENCY_TTL_HOURS.
+A retry with the same key gets the stored response back (marked
+`Idempotent-Replayed: true`) without touching stock. A duplicate arriving
+while the first one still runs loses the insert and gets a 409 to retry
+later, so no locks are needed. Server errors are not stored, so the
+client can retry them.
+"""
+import hashlib
+from functools import wraps
+
+from flask import current_app, jsonify, request
+from flask_jwt_extended import get_jwt_identity
+
+from app.models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+
+def replay(record, request_hash):
+    if record is None or record.status is None:
+        response = jsonify({"error": "A request with this Idempotency-Key is still being processed"})
+        response.headers['Retry-After'] = '1'
+        return response, 409
+    if record.request_hash != request_hash:
+        return jsonify({"error": "Idempotency-Key was already used for a different request"}), 422
+    response = jsonify(record.response)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, record.status
+
+
+def idempotent(view):
+    """Route decorator (inside jwt_required): replay the first outcome for a repeated Idempotency-Key"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({"error": f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters"}), 400
+
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+        record, claimed = IdempotencyKey.claim(get_jwt_identity(), request.endpoint, key, request_hash)
+        if not claimed:
+            return replay(record, request_hash)
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            record.release()
+            raise
+        if response.status_code >= 500:
+            record.release()
+        else:
+            record.complete(response.status_code, response.get_json(silent=True))
+        return response
+    return wrapper
@@ -0,0 +1,194 @@
+"""
+Per-request MongoDB instrumentation.
+
+A pymongo CommandListener (passed to both connections in app.db) records
+every command issued while a Flask request is being handled: how many there
+were, their total time, and the slowest ones with their collection and
+filter shape (values replaced by "?"). Each response gets a Server-Timing
+header:
+
+    Server-Timing: db;dur=4.2;desc="3 queries", app;dur=9.8
+
+Each request also logs one structured line (see app.logs) on the
+"app.instrumentation" logger. Commands slower than SLOW_QUERY_MS are logged as warnings with
+their shape.
+
+`query_budget(n)` declares how many commands a view may issue. Going over
+raises in debug mode (or with QUERY_BUDGET_STRICT=true), so a new N+1
+fails during development; in production it only logs a warning.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, request
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("INSTRUMENTATION_ENABLED", "true").lower() == "true"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+STRICT_BUDGETS = os.getenv("QUERY_BUDGET_STRICT", "false").lower() == "true"
+SLOWEST_KEPT = 3
+# Cursor continuations and driver housekeeping add time but are not separate
+# queries; counting them would make budgets depend on the data size
+UNCOUNTED_COMMANDS = {
+    'getMore', 'killCursors', 'endSessions', 'hello', 'isMaster', 'ismaster', 'ping',
+    'saslStart', 'saslContinue', 'buildInfo',
+}
+
+# Where each command type keeps its filter
+FILTER_KEYS = {
+    'find': 'filter', 'count': 'query', 'distinct': 'query', 'findAndModify': 'query',
+    'update': 'updates', 'delete': 'deletes', 'aggregate': 'pipeline',
+}
+
+
+def query_shape(value):
+    """Replace every literal in a filter with '?' so similar queries look the same"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        # $in lists and the like: the shape of one element is enough
+        return [query_shape(value[0])] if value else []
+    return '?'
+
+
+def command_filter(command_name, command):
+    key = FILTER_KEYS.get(command_name)
+    value = command.get(key) if key else None
+    if command_name in ('update', 'delete') and value:
+        return value[0].get('q')
+    if command_name == 'aggregate' and value:
+        return value[0].get('$match')
+    return value
+
+
+class RequestStats:
+    __slots__ = ('count', 'total_ms', 'slowest', 'pending')
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.slowest = []  # min-heap of (ms, sequence, details)
+        self.pending = {}
+
+    def record(self, ms, details):
+        self.total_ms += ms
+        if details['command'] in UNCOUNTED_COMMANDS:
+            return
+        self.count += 1
+        entry = (ms, self.count, details)
+        if len(self.slowest) < SLOWEST_KEPT:
+            heapq.heappush(self.slowest, entry)
+        elif ms > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def slowest_commands(self):
+        return [dict(details, ms=round(ms, 2)) for ms, _, details in sorted(self.slowest, reverse=True)]
+
+
+_local = threading.local()
+
+
+def current_stats():
+    """Stats of the request being handled on this thread, or None"""
+    return getattr(_local, 'stats', None)
+
+
+class QueryTracker(monitoring.CommandListener):
+    """Attributes commands to the request on the issuing thread (pymongo calls listeners synchronously)"""
+
+    def started(self, event):
+        stats = current_stats()
+        if stats is not None:
+            collection = event.command.get(event.command_name)
+            stats.pending[event.request_id] = {
+                'command': event.command_name,
+                'collection': collection if isinstance(collection, str) else None,
+                'shape': query_shape(command_filter(event.command_name, event.command)),
+            }
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        stats = current_stats()
+        if stats is None:
+            return
+        details = stats.pending.pop(event.request_id, None)
+        if details is None:
+            return
+        ms = event.duration_micros / 1000
+        stats.record(ms, details)
+        if ms >= SLOW_QUERY_MS:
+            logger.warning("slow query", extra={'path': request.path, 'ms': round(ms, 2), **details})
+
+
+query_tracker = QueryTracker()
+
+
+def _start_request():
+    _local.stats = RequestStats()
+    g.request_started = time.perf_counter()
+
+
+def _finish_request(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+    total_ms = (time.perf_counter() - g.request_started) * 1000
+    response.headers.add(
+        'Server-Timing', f'db;dur={stats.total_ms:.1f};desc="{stats.count} queries", app;dur={total_ms:.1f}'
+    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("request", extra={
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(total_ms, 2),
+            'db_queries': stats.count,
+            'db_ms': round(stats.total_ms, 2),
+            'slowest': stats.slowest_commands(),
+        })
+    return response
+
+
+def _teardown_request(exc):
+    _local.stats = None
+
+
+def init_app(app):
+    if not ENABLED:
+        return
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+
+
+def query_budget(limit):
+    """Route decorator: the view may issue at most `limit` MongoDB commands"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            stats = current_stats()
+            if stats is None:
+                return view(*args, **kwargs)
+            before = stats.count
+            result = view(*args, **kwargs)
+            used = stats.count - before
+            if used > limit:
+                message = f"{request.endpoint} issued {used} queries, over its budget of {limit}"
+                if current_app.debug or STRICT_BUDGETS:
+                    raise AssertionError(f"{message}: {stats.slowest_commands()}")
+                logger.warning(message, extra={'slowest': stats.slowest_commands()})
+            return result
+        return wrapper
+    return decorator
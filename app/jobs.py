@@ -0,0 +1,161 @@
+"""
+Maintenance jobs, exposed as Flask CLI commands (see create_app).
+
+    flask --app run reconcile-inventory [--shop <id> ...] [--dry-run]
+    flask --app run reconcile-notifications
+    flask --app run sweep-expired
+"""
+import time
+
+import click
+from bson import ObjectId
+
+from app.models import (
+    Invitation, Notification, OneTimePassword, PasswordResetToken, Product, Shop, User,
+    LOW_STOCK_EXPRESSIONS, invitation_expiry
+)
+
+STOCK_COUNTERS = ('inventory_value', 'total_units', 'low_stock_count', 'out_of_stock_count')
+
+
+def compute_stock_counters(shop_ids=None):
+    """Recompute every shop's stock counters from its products with one aggregation"""
+    match = {'shop': {'$in': list(shop_ids)}} if shop_ids else {}
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': '$shop',
+            'inventory_value': {'$sum': {'$multiply': ['$price', '$quantity']}},
+            'total_units': {'$sum': '$quantity'},
+            'low_stock_count': {'$sum': {'$cond': [
+                {'$lte': ['$quantity', {'$ifNull': ['$threshold', 0]}]}, 1, 0
+            ]}},
+            'out_of_stock_count': {'$sum': {'$cond': [{'$eq': ['$quantity', 0]}, 1, 0]}},
+        }},
+    ]
+    return {row.pop('_id'): row for row in Product._get_collection().aggregate(pipeline)}
+
+
+def reconcile_stock_counters(shop_ids=None, repair=True):
+    """Compare stored shop counters with the products and repair any drift.
+
+    Returns a list of (shop_id, field, stored, actual) tuples. Repairs are
+    conditional on the stored values read, so a shop that changed meanwhile
+    is left for the next run instead of being overwritten.
+    """
+    actual_by_shop = compute_stock_counters(shop_ids)
+    shops = Shop.objects(id__in=shop_ids) if shop_ids else Shop.objects
+    drift = []
+    for stored in shops.only(*STOCK_COUNTERS).as_pymongo():
+        actual = actual_by_shop.get(stored['_id'], dict.fromkeys(STOCK_COUNTERS, 0))
+        changed = {}
+        for field in STOCK_COUNTERS:
+            stored_value = stored.get(field, 0)
+            if abs(stored_value - actual[field]) > 0.005:
+                drift.append((stored['_id'], field, stored_value, actual[field]))
+                changed[field] = actual[field]
+        if changed and repair:
+            condition = {field: stored.get(field, 0) for field in STOCK_COUNTERS if field in stored}
+            updates = {f'set__{field}': value for field, value in changed.items()}
+            Shop.objects(id=stored['_id'], **condition).update_one(inc__data_version=1, **updates)
+    return drift
+
+
+def reconcile_low_stock_flags(shop_ids=None):
+    """Recompute is_low_stock/stock_deficit where they disagree with quantity/threshold.
+
+    Also backfills products created before the fields existed. Returns the
+    number of products fixed.
+    """
+    mismatch = {'$or': [
+        {'$ne': [{'$ifNull': ['$' + field, None]}, expression]}
+        for field, expression in LOW_STOCK_EXPRESSIONS.items()
+    ]}
+    query = {'$expr': mismatch}
+    if shop_ids:
+        query['shop'] = {'$in': list(shop_ids)}
+    result = Product._get_collection().update_many(query, [{'$set': LOW_STOCK_EXPRESSIONS}])
+    return result.modified_count
+
+
+@click.command('reconcile-inventory')
+@click.option('--shop', 'shop_ids', multiple=True, help='Only reconcile these shop ids')
+@click.option('--dry-run', is_flag=True, help='Report drift without repairing it')
+def reconcile_inventory_command(shop_ids, dry_run):
+    """Detect and repair drift in shop stock counters and product low-stock flags."""
+    shop_ids = [ObjectId(s) for s in shop_ids] or None
+    drift = reconcile_stock_counters(shop_ids, repair=not dry_run)
+    for shop_id, field, stored, actual in drift:
+        click.echo(f"{shop_id} {field}: stored {stored} actual {actual}")
+    click.echo(f"{len(drift)} drifted counter(s) {'found' if dry_run else 'repaired'}")
+    if not dry_run:
+        click.echo(f"{reconcile_low_stock_flags(shop_ids)} low-stock flag(s) repaired")
+
+
+def reconcile_unread_counters():
+    """Reset every user's unread_notifications to the number of unread notifications they have.
+
+    Returns the number of users whose counter was wrong.
+    """
+    pipeline = [
+        {'$match': {'read': {'$ne': True}}},
+        {'$group': {'_id': '$recipient', 'unread': {'$sum': 1}}},
+    ]
+    actual = {row['_id']: row['unread'] for row in Notification._get_collection().aggregate(pipeline)}
+    fixed = 0
+    for user in User.objects.only('unread_notifications').as_pymongo():
+        unread = actual.get(user['_id'], 0)
+        if user.get('unread_notifications') != unread:
+            # Conditional so a notification created meanwhile is not lost
+            fixed += User.objects(id=user['_id'], unread_notifications=user.get('unread_notifications')) \
+                .update_one(set__unread_notifications=unread)
+    return fixed
+
+
+def backfill_notification_names():
+    """Fill sender_name/shop_name on notifications created before they were stored"""
+    filled = 0
+    for shop in Shop.objects.only('name').as_pymongo():
+        filled += Notification.objects(shop=shop['_id'], shop_name=None).update(set__shop_name=shop['name'])
+    missing = {'sender': {'$ne': None}, 'sender_name': None}
+    for sender_id in Notification._get_collection().distinct('sender', missing):
+        user = User.objects(id=sender_id).only('name').as_pymongo().first()
+        if user:
+            filled += Notification.objects(sender=sender_id, sender_name=None).update(set__sender_name=user['name'])
+    return filled
+
+
+@click.command('reconcile-notifications')
+def reconcile_notifications_command():
+    """Backfill denormalized notification names and repair unread counters."""
+    click.echo(f"{backfill_notification_names()} notification name(s) filled")
+    click.echo(f"{reconcile_unread_counters()} unread counter(s) repaired")
+
+
+def migrate_expiring_documents():
+    """Bring documents written before TTL expiry existed under their TTL indexes.
+
+    Converts epoch-float reset token expiries to dates, gives old invitations
+    an expiry, and moves still-valid OTPs off user documents into the otps
+    collection. Returns counts per step.
+    """
+    tokens = PasswordResetToken._get_collection().update_many(
+        {'expiry': {'$type': 'double'}},
+        [{'$set': {'expiry': {'$toDate': {'$multiply': ['$expiry', 1000]}}}}]
+    ).modified_count
+    invitations = Invitation.objects(expires_at=None).update(set__expires_at=invitation_expiry())
+
+    now = time.time()
+    moved = 0
+    for user in User.objects(otp__ne=None, otp_expiry__gt=now).only('otp', 'otp_expiry').as_pymongo():
+        OneTimePassword.issue(user['_id'], user['otp'], int(user['otp_expiry'] - now))
+        moved += 1
+    User.objects(otp__exists=True).update(unset__otp=True, unset__otp_expiry=True)
+    return {'reset tokens': tokens, 'invitations': invitations, 'otps': moved}
+
+
+@click.command('sweep-expired')
+def sweep_expired_command():
+    """Migrate legacy expiry fields so TTL indexes reap tokens, OTPs and invitations."""
+    for name, count in migrate_expiring_documents().items():
+        click.echo(f"{count} {name} migrated")
@@ -0,0 +1,152 @@
+"""
+Application logging: JSON lines written off the request thread.
+
+Handlers only put records on a bounded queue (QueueHandler), and a
+QueueListener thread formats and writes them to stderr. A slow or blocked
+stream therefore never stalls a request. stdout is left to CLI commands and
+benchmarks, whose output other tools parse. When the queue is full, records
+are dropped and counted rather than blocking.
+
+Every record is a JSON object with the time, level, logger, message, the
+id of the request it was logged in (`X-Request-ID`, generated when the
+client sends none, echoed on the response) and any `extra=` fields.
+
+    LOG_LEVEL=INFO                                   # root level
+    LOG_LEVELS="app.instrumentation=WARNING,pymongo=WARNING"
+    LOG_DEBUG_SAMPLE_RATE=0.1                        # keep 1 in 10 DEBUG records
+"""
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
+from flask import g, has_request_context, request
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.1"))
+QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+REQUEST_ID_HEADER = "X-Request-ID"
+# Client-supplied request ids end up in every log line; accept only plain tokens
+VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+# Attributes every LogRecord has; anything else came from `extra=`
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class RequestContextFilter(logging.Filter):
+    """Runs in the thread that logs, before the record is queued, so it still sees the Flask request"""
+
+    def filter(self, record):
+        record.request_id = g.get('request_id') if has_request_context() else None
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Keep a fraction of DEBUG records so verbose loggers can stay on under load"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+    def prepare(self, record):
+        # Render the message and traceback here, where args and exc_info are
+        # still valid, but keep the record's own fields for the JSON formatter
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_levels(spec):
+    """"a=WARNING,b.c=DEBUG" -> {'a': 'WARNING', 'b.c': 'DEBUG'}"""
+    levels = {}
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        name, _, level = part.partition('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """Route all logging through the queue; safe to call more than once"""
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JSONFormatter())
+
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    handler.addFilter(RequestContextFilter())
+    handler.addFilter(DebugSampler(DEBUG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    # Flush what is still queued on a clean shutdown
+    atexit.register(_listener.stop)
+
+
+def _assign_request_id():
+    supplied = request.headers.get(REQUEST_ID_HEADER, '')
+    g.request_id = supplied if VALID_REQUEST_ID.match(supplied) else uuid.uuid4().hex
+
+
+def _echo_request_id(response):
+    if 'request_id' in g:
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+
+def init_app(app):
+    configure_logging()
+    app.before_request(_assign_request_id)
+    app.after_request(_echo_request_id)
@@ -0,0 +1,176 @@
+"""
+Prometheus metrics: request latency and throughput, MongoDB connection
+pools, outbound SMTP/Cloudinary calls, sales/restocks and forecast fits.
+
+Under gunicorn every worker is a separate process. When
+PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it), each process
+writes its samples to memory-mapped files in that directory and /metrics
+merges them, whichever worker serves the scrape. Without it (flask run,
+tests) the default in-process registry is used. Recording a sample is a
+few dictionary lookups and a float add, so the metrics stay on in
+production.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Time spent handling a request',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'Requests currently being handled',
+    ['method', 'route'], multiprocess_mode='livesum',
+)
+
+POOL_CONNECTIONS = Gauge(
+    'mongo_pool_connections', 'Open MongoDB connections', ['address'], multiprocess_mode='livesum',
+)
+POOL_CHECKED_OUT = Gauge(
+    'mongo_pool_checked_out_connections', 'MongoDB connections in use', ['address'], multiprocess_mode='livesum',
+)
+POOL_CHECKOUT_WAIT = Histogram(
+    'mongo_pool_checkout_seconds', 'Time spent waiting for a MongoDB connection', ['address'],
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5),
+)
+POOL_CHECKOUT_FAILURES = Counter(
+    'mongo_pool_checkout_failures_total', 'Failed MongoDB connection checkouts', ['address', 'reason'],
+)
+
+EXTERNAL_CALL_DURATION = Histogram(
+    'external_call_duration_seconds', 'Latency of calls to external services',
+    ['service', 'outcome'], buckets=LATENCY_BUCKETS + (30,),
+)
+
+SALES = Counter('sales_total', 'Completed sale transactions')
+UNITS_SOLD = Counter('sale_units_total', 'Units sold')
+SALES_REVENUE = Counter('sale_revenue_total', 'Revenue from completed sales')
+RESTOCKS = Counter('restocks_total', 'Completed restock transactions')
+UNITS_RESTOCKED = Counter('restock_units_total', 'Units restocked')
+
+FORECAST_FIT_DURATION = Histogram(
+    'forecast_fit_seconds', 'Time spent fitting a demand forecast model',
+    buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool gauges, passed to both connections in app.db"""
+
+    def connection_created(self, event):
+        POOL_CONNECTIONS.labels(_address(event)).inc()
+
+    def connection_closed(self, event):
+        POOL_CONNECTIONS.labels(_address(event)).dec()
+
+    def connection_checked_out(self, event):
+        POOL_CHECKED_OUT.labels(_address(event)).inc()
+        # Wait time is only reported by pymongo 4.7+
+        duration = getattr(event, 'duration', None)
+        if duration is not None:
+            POOL_CHECKOUT_WAIT.labels(_address(event)).observe(duration)
+
+    def connection_checked_in(self, event):
+        POOL_CHECKED_OUT.labels(_address(event)).dec()
+
+    def connection_check_out_failed(self, event):
+        POOL_CHECKOUT_FAILURES.labels(_address(event), event.reason).inc()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+def _address(event):
+    host, port = event.address
+    return f"{host}:{port}"
+
+
+pool_metrics = PoolMetrics()
+
+
+@contextmanager
+def external_call(service):
+    """Time a call to an external service, labelled with whether it raised"""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        EXTERNAL_CALL_DURATION.labels(service, outcome).observe(time.perf_counter() - start)
+
+
+def record_sale(transaction):
+    SALES.inc()
+    UNITS_SOLD.inc(sum(item.quantity for item in transaction.payload))
+    SALES_REVENUE.inc(transaction.total or 0)
+
+
+def record_restock(units):
+    RESTOCKS.inc()
+    UNITS_RESTOCKED.inc(units)
+
+
+def _route():
+    # The URL rule, not the path, so ids in URLs do not create new series
+    return request.url_rule.rule if request.url_rule else '<unmatched>'
+
+
+def _start_request():
+    g.metrics_labels = (request.method, _route())
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_PROGRESS.labels(*g.metrics_labels).inc()
+
+
+def _record_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def _finish_request(exc):
+    labels = g.pop('metrics_labels', None)
+    if labels is None:
+        return
+    REQUESTS_IN_PROGRESS.labels(*labels).dec()
+    # Unhandled exceptions skip after_request handlers and end up as a 500
+    status = g.pop('metrics_status', 500)
+    REQUEST_DURATION.labels(*labels, status).observe(time.perf_counter() - g.metrics_started)
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_finish_request)
+
+
+def render():
+    """Return (body, content type) for a scrape of this process or, under gunicorn, of all workers"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
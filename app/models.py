@@ -1,9 +1,49 @@
-from werkzeug.security import generate_password_hash, check_password_hash
 import mongoengine as me
-from datetime import datetime
-import time
+from datetime import datetime, timedelta
+import os
 import pyotp
 from bson import ObjectId
+from pymongo import ReturnDocument
+from app.serialization import to_json_ready
+from app.broker import broker
+from app.passwords import hash_password, verify_password, rehash_in_background
+
+
+# When true, derived side effects of stock/sales writes (shop counters, data
+# versions, low-stock alerts, item-driven quantities) are left to the
+# change-stream worker (app/change_stream.py) instead of running in the request
+ASYNC_SIDE_EFFECTS = os.getenv("ASYNC_SIDE_EFFECTS", "false").lower() == "true"
+
+
+def ref_id(value):
+    """Return the ObjectId behind a reference value without dereferencing it"""
+    return getattr(value, 'id', value)
+
+
+# Aggregation expressions deriving Product's low-stock fields from quantity/threshold,
+# used in pipeline updates so the flag changes atomically with the quantity
+LOW_STOCK_EXPRESSIONS = {
+    'is_low_stock': {'$lte': ['$quantity', {'$ifNull': ['$threshold', 0]}]},
+    'stock_deficit': {'$subtract': [{'$ifNull': ['$threshold', 0]}, '$quantity']},
+}
+# Pipeline-update expression bumping Product.version; every write that changes
+# a product's quantity must use it so compare-and-swap saves notice the change
+BUMP_VERSION = {'version': {'$add': [{'$ifNull': ['$version', 0]}, 1]}}
+PRODUCT_SAVE_ATTEMPTS = 5
+
+
+def stock_contribution(state):
+    """What one product with state (quantity, price, threshold) adds to its shop's counters"""
+    if state is None:
+        return {'inventory_value': 0, 'total_units': 0, 'low_stock_count': 0, 'out_of_stock_count': 0}
+    quantity, price, threshold = state
+    return {
+        'inventory_value': price * quantity,
+        'total_units': quantity,
+        'low_stock_count': int(quantity <= threshold),
+        'out_of_stock_count': int(quantity == 0),
+    }
+
 
 """
 Base Model
@@ -16,16 +56,19 @@ class BaseModel(me.Document):
         if 'id' in kwargs:
             try:
                 # Convert string id to ObjectId
-                kwargs['_id'] = ObjectId(kwargs.pop('id'))
+                kwargs['id'] = ObjectId(kwargs['id'])
             except Exception:
                 # If conversion fails, keep the original id
-                kwargs['_id'] = kwargs.pop('id')
+                pass
         super().__init__(*args, **kwargs)
 
     def get_serialized(self):
-        data = self.to_mongo().to_dict()
-        data["id"] = str(data.pop("_id"))
-        return data
+        return self.serialize(self.to_mongo().to_dict())
+
+    @classmethod
+    def serialize(cls, raw):
+        """Serialize a raw document, as returned by to_mongo() or as_pymongo()"""
+        return to_json_ready(raw)
 
     @classmethod
     def get_by_id(cls, id):
@@ -49,6 +92,8 @@ class User(BaseModel):
     name = me.StringField(required=True)
     email = me.EmailField(required=True, unique=True)
     password_hash = me.StringField(required=True)
+    # Legacy: OTPs now live in the otps collection (OneTimePassword);
+    # `flask sweep-expired` unsets these on old user documents
     otp = me.StringField()
     otp_expiry = me.FloatField()
     role = me.StringField()
@@ -56,66 +101,67 @@ class User(BaseModel):
     shops = me.ListField(me.ReferenceField('Shop')) 
     isVerified = me.BooleanField(required=True, default=False)
     canRestock = me.BooleanField(default=False)
+    # Maintained with $inc by Notification.save and mark_read
+    unread_notifications = me.IntField(default=0)
     
     meta = {'collection': 'users'}
 
     def __init__(self, *args, password=None, **kwargs):
         if password:
-            kwargs['password_hash'] = generate_password_hash(password, method="scrypt")
+            kwargs['password_hash'] = hash_password(password)
         super().__init__(*args, **kwargs)
 
 
-    def get_serialized(self):
-        data = self.to_mongo().to_dict()
-        data["id"] = str(data.pop("_id"))
-        data.pop('password_hash')
-        data.pop('otp', None)
-        data.pop('otp_expiry', None)
-        if data['role'] == "owner":
-            try:
-                data['shops'] = [str(shop.id) for shop in self.shops]
-                data.pop('shop')
-            except KeyError:
-                pass
+    @classmethod
+    def serialize(cls, raw):
+        data = to_json_ready(raw, exclude=('password_hash', 'otp', 'otp_expiry'))
+        if data.get('role') == "owner":
+            data['shops'] = data.get('shops', [])
+            data.pop('shop', None)
         else:
-            try:
-                data['shop'] = str(self.shop.id) if self.shop else None
-                data.pop('shops')
-            except KeyError:
-                pass
-            
+            data['shop'] = data.get('shop')
+            data.pop('shops', None)
         return data
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+    def upgrade_password_hash(self, password):
+        """After a successful login, rehash in the background if the hash uses outdated parameters"""
+        old_hash = self.password_hash
+
+        def save(new_hash):
+            # Conditional so a password changed in the meantime is not overwritten
+            User.objects(id=self.id, password_hash=old_hash).update_one(set__password_hash=new_hash)
+
+        rehash_in_background(old_hash, password, save)
 
     @staticmethod
     def get_by_email(email):
         return User.objects(email=email).first()
 
+    def accessible_shop_ids(self):
+        """Ids of the shops this user works in, read from the references without dereferencing them"""
+        if self.role == "owner":
+            return [ref_id(shop) for shop in self._data.get('shops') or []]
+        if self.role == "employee" and self._data.get('shop'):
+            return [ref_id(self._data.get('shop'))]
+        return []
+
 
     def set_otp(self, otp_code, expiry_seconds=300):
         """Store OTP and expiration in DB (5 min default)"""
-        self.otp = otp_code
-        self.otp_expiry = time.time() + expiry_seconds
-        self.save()
+        OneTimePassword.issue(self.id, otp_code, expiry_seconds)
 
     def verify_otp(self, otp_code):
-        """Check if OTP is valid and not expired"""
-        if self.otp and self.otp_expiry:
-            if time.time() > self.otp_expiry:
-                # Clear expired OTP
-                self.otp = None
-                self.otp_expiry = None
-                self.save()
-                return False, "OTP expired"
-            if self.otp == otp_code:
-                self.isVerified = True
-                # Clear OTP after successful verification
-                self.otp = None
-                self.otp_expiry = None
-                self.save()
-                return True, "OTP verified"
+        """Check if OTP is valid and not expired, consuming it if so"""
+        if OneTimePassword.consume(self.id, otp_code):
+            self.isVerified = True
+            User.objects(id=self.id).update_one(set__isVerified=True)
+            return True, "OTP verified"
+        # Only failed attempts pay for telling an expired code from a wrong one
+        if OneTimePassword.objects(user=self.id, code=otp_code).only('id').first():
+            return False, "OTP expired"
         return False, "Invalid OTP"
     
     def set_password_reset_token(self):
@@ -124,7 +170,7 @@ class User(BaseModel):
         PasswordResetToken.objects(user=self).delete()
         
         token = pyotp.random_base32() # Using pyotp for a random string, could be uuid
-        expiry_time = time.time() + 3600  # Token expires in 1 hour
+        expiry_time = datetime.utcnow() + timedelta(hours=1)  # Token expires in 1 hour
         reset_token_doc = PasswordResetToken(user=self, token=token, expiry=expiry_time)
         reset_token_doc.save()
         return token
@@ -142,7 +188,15 @@ class Shop(BaseModel):
     name = me.StringField(required=True)
     address = me.StringField(required=True)
     owner = me.ReferenceField('User', required=True, reverse_delete_rule=me.CASCADE)
+    # Stock counters maintained with $inc on every stock/price/threshold change
+    # (see Shop.record_stock_change); `flask reconcile-inventory` repairs drift
     inventory_value = me.FloatField(default=0)
+    total_units = me.IntField(default=0)
+    low_stock_count = me.IntField(default=0)
+    out_of_stock_count = me.IntField(default=0)
+    # Bumped on every write that changes the shop's stock or sales figures;
+    # cached dashboard data is keyed on it
+    data_version = me.IntField(default=0)
 
     meta = {'collection': 'shops'}
 
@@ -155,15 +209,39 @@ class Shop(BaseModel):
                 kwargs['owner'] = kwargs.pop('owner_id')
         super().__init__(*args, **kwargs)
 
-    def get_serialized(self):
-        data = super().get_serialized()
-        if 'owner' in data and data['owner'] is not None:
-            data['owner'] = str(self.owner.id)
-        return data
-    
     @classmethod
     def get_by_owner_id(cls, owner_id):
         return cls.objects(owner=owner_id)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # $inc separately so a save never overwrites concurrent bumps
+        Shop.bump_version(self.id)
+        return self
+
+    @classmethod
+    def bump_version(cls, shop_id):
+        if shop_id:
+            cls.objects(id=shop_id).update_one(inc__data_version=1)
+
+    @classmethod
+    def record_stock_change(cls, shop_id, before, after):
+        """Apply a product's stock state change to its shop's counters in one atomic update.
+
+        `before`/`after` are (quantity, price, threshold) tuples, None for a
+        product that did not exist before or no longer exists after.
+        """
+        if not shop_id:
+            return
+        old, new = stock_contribution(before), stock_contribution(after)
+        update = {f'inc__{field}': new[field] - old[field] for field in new if new[field] != old[field]}
+        cls.objects(id=shop_id).update_one(inc__data_version=1, **update)
+
+    @classmethod
+    def get_data_version(cls, shop_id):
+        """Read only the version stamp of a shop, or None if it does not exist"""
+        doc = cls.objects(id=shop_id).only('data_version').as_pymongo().first()
+        return doc.get('data_version', 0) if doc else None
     
 
 """
@@ -179,8 +257,20 @@ class Product(BaseModel):
     description = me.StringField(defaults="")
     category = me.StringField(defaults="")
     image_url = me.StringField(default="")
-
-    meta = {'collection': 'products'}
+    # Derived from quantity/threshold on every stock write and indexed with the
+    # shop, so the critical-products list is an index query sorted by deficit
+    is_low_stock = me.BooleanField(default=False)
+    stock_deficit = me.IntField(default=0)
+    # Last low-stock alert, used to debounce alerts per product
+    low_stock_alerted_at = me.DateTimeField()
+    # Incremented by every write; save() only succeeds if it is unchanged since
+    # the product was read, so a stale read can never overwrite newer stock
+    version = me.IntField(default=0)
+
+    meta = {
+        'collection': 'products',
+        'indexes': [('shop', 'is_low_stock', '-stock_deficit')]
+    }
 
     def __init__(self, *args, **kwargs):
         # Handle shop_id if provided
@@ -190,18 +280,109 @@ class Product(BaseModel):
             except Exception:
                 kwargs['shop'] = kwargs.pop('shop_id')
         super().__init__(*args, **kwargs)
+        # Stock state as stored in the DB, to diff against on save
+        self._stock_snapshot = None if self._created else self.stock_state()
 
-    def get_serialized(self):
-        data = self.to_mongo().to_dict()
-        data["id"] = str(data.pop("_id"))
-        data["shop_id"] = str(data.pop("shop"))
-        return data
+    @classmethod
+    def serialize(cls, raw, fields=None):
+        return to_json_ready(raw, renames={'shop': 'shop_id'}, fields=fields)
+
+    def stock_state(self):
+        return (int(self.quantity or 0), float(self.price or 0), int(self.threshold or 0))
+
+    def save(self, *args, **kwargs):
+        quantity, _, threshold = self.stock_state()
+        self.is_low_stock = quantity <= threshold
+        self.stock_deficit = threshold - quantity
+        version = self.version or 0
+        if not self._created:
+            # Products written before versioning have no version field; $in with None matches those
+            kwargs.setdefault('save_condition', {'version__in': [0, None]} if version == 0 else {'version': version})
+            self.version = version + 1
+        try:
+            super().save(*args, **kwargs)
+        except me.errors.SaveConditionError:
+            self.version = version
+            raise
+        after = self.stock_state()
+        Product.stock_changed(self.id, ref_id(self._data.get('shop')), self.name, self._stock_snapshot, after)
+        self._stock_snapshot = after
+        return self
+
+    def delete(self, *args, **kwargs):
+        shop_id = ref_id(self._data.get('shop'))
+        super().delete(*args, **kwargs)
+        Product.stock_changed(self.id, shop_id, self.name, self._stock_snapshot, None)
+
+    @classmethod
+    def stock_changed(cls, product_id, shop_id, name, before, after):
+        """Side effects of a product's (quantity, price, threshold) moving from before to after"""
+        if ASYNC_SIDE_EFFECTS:
+            return
+        Shop.record_stock_change(shop_id, before, after)
+        if before and after and before[0] > before[2] and after[0] <= after[2]:
+            from app.alerts import notify_low_stock
+            notify_low_stock(product_id, shop_id, name, after[0], after[2])
 
 
     @classmethod
     def get_product_by_id(cls, id):
         return cls.objects(id=id).first()
 
+    @classmethod
+    def update_with_retry(cls, product_id, apply, expected_version=None, attempts=PRODUCT_SAVE_ATTEMPTS):
+        """Read the product, apply(product) and save it, re-reading and retrying if another write got in between.
+
+        With expected_version (the version the client last saw) there is a
+        single attempt. Returns the saved product, or None if it does not
+        exist. Raises SaveConditionError when every attempt lost the race.
+        """
+        if expected_version is not None:
+            attempts = 1
+        for attempt in range(attempts):
+            product = cls.get_by_id(product_id)
+            if product is None:
+                return None
+            if expected_version is not None and (product.version or 0) != expected_version:
+                raise me.errors.SaveConditionError(f"Product is at version {product.version or 0}, not {expected_version}")
+            apply(product)
+            try:
+                return product.save()
+            except me.errors.SaveConditionError:
+                if attempt == attempts - 1:
+                    raise
+
+    @classmethod
+    def get_shop_id(cls, product_id):
+        doc = cls.objects(id=product_id).only('shop').as_pymongo().first()
+        return doc.get('shop') if doc else None
+
+    @classmethod
+    def adjust_quantity(cls, product_id, delta, only_if_available=False):
+        """Atomically add delta to a product's quantity and refresh its low-stock fields.
+
+        Returns the updated raw document (or None if the product is gone, or
+        with only_if_available, if a decrement would take the quantity below
+        zero) so callers can react to the new stock level without another read.
+        """
+        query = {'_id': ObjectId(str(product_id))}
+        if only_if_available and delta < 0:
+            query['quantity'] = {'$gte': -delta}
+        doc = cls._get_collection().find_one_and_update(
+            query,
+            [
+                {'$set': {'quantity': {'$add': ['$quantity', delta]}, **BUMP_VERSION}},
+                {'$set': LOW_STOCK_EXPRESSIONS},
+            ],
+            projection={'shop': 1, 'name': 1, 'quantity': 1, 'threshold': 1, 'price': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc:
+            after = (doc.get('quantity', 0), doc.get('price', 0), doc.get('threshold', 0))
+            before = (after[0] - delta,) + after[1:]
+            cls.stock_changed(doc['_id'], doc.get('shop'), doc.get('name'), before, after)
+        return doc
+
 
 """
 Item Model
@@ -221,16 +402,40 @@ class Item(BaseModel):
         super().__init__(*args, **kwargs)
 
     def save(self, *args, **kwargs):
-        if self.product:
-            Product.objects(id=self.product.id).update_one(inc__quantity=1)
-
+        product_id = ref_id(self._data.get('product'))
+        created = self.pk is None
+        # Insert first: a duplicate barcode raises NotUniqueError before the quantity moves
         super().save(*args, **kwargs)
+        if created and product_id and not ASYNC_SIDE_EFFECTS:
+            Product.adjust_quantity(product_id, 1)
+        return self
 
     def delete(self, *args, **kwargs):
-        if self.product:
-            Product.objects(id=self.product.id).update_one(dec__quantity=1) 
+        product_id = ref_id(self._data.get('product'))
+        # Only the call that actually removed the item takes it off the quantity
+        removed = type(self).objects(pk=self.pk).delete()
+        if removed and product_id and not ASYNC_SIDE_EFFECTS:
+            Product.adjust_quantity(product_id, -1)
 
-        super().delete(*args, **kwargs)
+    @classmethod
+    def take(cls, barcode, product_id):
+        """Atomically remove the item with this barcode from the product and return it.
+
+        Returns None if there is no such item, e.g. because a concurrent sale
+        already took it.
+        """
+        item = cls.objects(barcode=barcode, product=product_id).modify(remove=True)
+        if item and not ASYNC_SIDE_EFFECTS:
+            Product.adjust_quantity(product_id, -1)
+        return item
+
+    @classmethod
+    def remove_barcodes(cls, product_id, barcodes):
+        """Delete the product's items with these barcodes, taking the number removed off its quantity"""
+        removed = cls.objects(product=product_id, barcode__in=barcodes).delete()
+        if removed and not ASYNC_SIDE_EFFECTS:
+            Product.adjust_quantity(product_id, -removed)
+        return removed
 
     @classmethod
     def get_by_barcode(cls, barcode):
@@ -284,6 +489,9 @@ class Transaction(BaseModel):
     transaction_type = me.StringField(choices=["sale", "restock"], required=True)
     payload = me.ListField(me.GenericEmbeddedDocumentField(), required=True)
     total = me.FloatField(required=True)
+    # Id the POS client gave a sale recorded offline (see app/sync.py); unique
+    # per shop so an upload that is retried is not applied twice
+    client_id = me.StringField()
 
     def __init__(self, *args, **kwargs):
         # Handle shop_id and user_id if provided
@@ -323,9 +531,7 @@ class Transaction(BaseModel):
                 )
             item_in_payload.clean() # Explicitly call clean on the RestockItemPayload
 
-    def save(self, *args, **kwargs):
-        self.clean()
-
+    def compute_total(self):
         current_total = 0.0
         if self.payload:
             if self.transaction_type == "sale":
@@ -340,11 +546,32 @@ class Transaction(BaseModel):
                     qty_to_consider = item.quantity # quantity is now correctly set in RestockItemPayload.clean()
                     current_total += item.cost_price * qty_to_consider
                 # else: already handled by clean()
-        
-        self.total = current_total
+        return current_total
+
+    def save(self, *args, **kwargs):
+        self.clean()
+        self.total = self.compute_total()
         super().save(*args, **kwargs)
+        if not ASYNC_SIDE_EFFECTS:
+            Shop.bump_version(ref_id(self._data.get('shop')))
+
+    meta = {
+        'collection': 'transactions',
+        'indexes': [
+            # Partial, so transactions created online (no client_id) are not indexed
+            {'fields': ['shop', 'client_id'], 'unique': True,
+             'partialFilterExpression': {'client_id': {'$type': 'string'}}},
+            # Sales charts of one shop or, with $in, of all of an owner's shops
+            ('shop', 'transaction_type', 'date'),
+        ]
+    }
+
+
+INVITATION_TTL = timedelta(days=int(os.getenv("INVITATION_TTL_DAYS", "7")))
 
-    meta = {'collection': 'transactions'}
+
+def invitation_expiry():
+    return datetime.utcnow() + INVITATION_TTL
 
 
 class Invitation(BaseModel):
@@ -352,22 +579,34 @@ class Invitation(BaseModel):
     shop_id = me.ReferenceField('Shop', required=True, reverse_delete_rule=me.CASCADE)
     canRestock = me.BooleanField(default=False)
     email = me.EmailField(required=True)
+    expires_at = me.DateTimeField(default=invitation_expiry)
 
-    meta = {'collection': 'invitations'}
+    meta = {
+        'collection': 'invitations',
+        # The server deletes invitations once expires_at has passed
+        'indexes': [{'fields': ['expires_at'], 'expireAfterSeconds': 0}]
+    }
 
     def __init__(self, *args, **kwargs):
-        # Handle shop_id if provided
-        if 'shop_id' in kwargs:
+        # The reference field itself is named shop_id; accept string ids for it
+        if isinstance(kwargs.get('shop_id'), str):
             try:
-                kwargs['shop'] = ObjectId(kwargs.pop('shop_id'))
+                kwargs['shop_id'] = ObjectId(kwargs['shop_id'])
             except Exception:
-                kwargs['shop'] = kwargs.pop('shop_id')
+                pass
         super().__init__(*args, **kwargs)
 
     @staticmethod
     def get_by_token(token):
         return Invitation.objects(token=token).first()
 
+    @classmethod
+    def consume(cls, token):
+        """Atomically fetch and delete an unexpired invitation (None if invalid or expired)"""
+        # The TTL monitor runs about once a minute, so expired documents may still exist
+        not_expired = me.Q(expires_at__gt=datetime.utcnow()) | me.Q(expires_at=None)
+        return cls.objects(me.Q(token=token) & not_expired).modify(remove=True)
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
@@ -385,9 +624,12 @@ Password Reset Token Model
 class PasswordResetToken(me.Document):
     user = me.ReferenceField('User', required=True, reverse_delete_rule=me.CASCADE)
     token = me.StringField(required=True, unique=True)
-    expiry = me.FloatField(required=True)
+    expiry = me.DateTimeField(required=True)
 
-    meta = {'collection': 'password_reset_tokens'}
+    meta = {
+        'collection': 'password_reset_tokens',
+        'indexes': [{'fields': ['expiry'], 'expireAfterSeconds': 0}]
+    }
 
     def __init__(self, *args, **kwargs):
         # Handle user_id if provided
@@ -402,23 +644,161 @@ class PasswordResetToken(me.Document):
     def get_by_token(cls, token):
         return cls.objects(token=token).first()
 
+    @classmethod
+    def consume(cls, token):
+        """Atomically fetch and delete an unexpired token (None if invalid or expired)"""
+        return cls.objects(token=token, expiry__gt=datetime.utcnow()).modify(remove=True)
+
     def is_expired(self):
-        return time.time() > self.expiry
+        return datetime.utcnow() > self.expiry
+
+
+"""
+One-Time Password Model
+"""
+class OneTimePassword(me.Document):
+    # One live OTP per user; kept out of the users collection so user reads stay small
+    user = me.ReferenceField('User', required=True, unique=True)
+    code = me.StringField(required=True)
+    expires_at = me.DateTimeField(required=True)
+
+    meta = {
+        'collection': 'otps',
+        'indexes': [{'fields': ['expires_at'], 'expireAfterSeconds': 0}]
+    }
+
+    @classmethod
+    def issue(cls, user_id, code, expiry_seconds=300):
+        """Store a user's OTP, replacing any previous one"""
+        cls.objects(user=user_id).update_one(
+            upsert=True,
+            set__code=code,
+            set__expires_at=datetime.utcnow() + timedelta(seconds=expiry_seconds)
+        )
+
+    @classmethod
+    def consume(cls, user_id, code):
+        """Atomically check and delete a user's unexpired OTP; True if it matched"""
+        return cls.objects(user=user_id, code=code, expires_at__gt=datetime.utcnow()).modify(remove=True) is not None
+
+"""
+Revoked Token Model
+"""
+class RevokedToken(me.Document):
+    # JWT ids revoked before their expiry (logout); the TTL index drops them
+    # once the token would have expired anyway
+    jti = me.StringField(required=True, unique=True)
+    revoked_at = me.DateTimeField(default=datetime.utcnow)
+    expires_at = me.DateTimeField(required=True)
+
+    meta = {
+        'collection': 'revoked_tokens',
+        'indexes': [
+            # Workers poll for revocations newer than the last one they saw
+            'revoked_at',
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},
+        ]
+    }
+
+    @classmethod
+    def revoke(cls, jti, expires_at):
+        cls.objects(jti=jti).update_one(
+            upsert=True,
+            set__expires_at=expires_at,
+            set_on_insert__revoked_at=datetime.utcnow()
+        )
+
+
+"""
+Idempotency Key Model
+"""
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+# A claim older than this whose request never finished (crashed worker) may be taken over
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+
+
+def idempotency_expiry():
+    return datetime.utcnow() + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+
+
+class IdempotencyKey(me.Document):
+    # First outcome of a request sent with an Idempotency-Key header; retries
+    # with the same key replay it. status is None while the request is running
+    scope = me.StringField(required=True)  # JWT identity of the caller
+    endpoint = me.StringField(required=True)
+    key = me.StringField(required=True)
+    request_hash = me.StringField(required=True)
+    status = me.IntField()
+    response = me.DynamicField()
+    locked_at = me.DateTimeField(default=datetime.utcnow)
+    expires_at = me.DateTimeField(default=idempotency_expiry)
+
+    meta = {
+        'collection': 'idempotency_keys',
+        'indexes': [
+            {'fields': ['scope', 'endpoint', 'key'], 'unique': True},
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},
+        ]
+    }
+
+    @classmethod
+    def claim(cls, scope, endpoint, key, request_hash):
+        """Return (record, claimed). Exactly one of several concurrent requests
+        with the same key wins the unique insert; the others get the record."""
+        for _ in range(2):
+            try:
+                return cls(scope=scope, endpoint=endpoint, key=key, request_hash=request_hash).save(force_insert=True), True
+            except me.NotUniqueError:
+                existing = cls.objects(scope=scope, endpoint=endpoint, key=key).first()
+            if existing is None:
+                continue  # expired or released in between; try the insert again
+            if existing.status is None and existing.locked_at < datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS):
+                taken = cls.objects(id=existing.id, status=None, locked_at=existing.locked_at).modify(
+                    new=True, set__locked_at=datetime.utcnow(), set__request_hash=request_hash
+                )
+                if taken is not None:
+                    return taken, True
+            return existing, False
+        return None, False
+
+    def complete(self, status, response):
+        IdempotencyKey.objects(id=self.id).update_one(set__status=status, set__response=response)
+
+    def release(self):
+        """Forget a failed attempt so the client can retry with the same key"""
+        IdempotencyKey.objects(id=self.id, status=None).delete()
+
 
 """
 Notification Model
 """
+READ_RETENTION_DAYS = int(os.getenv("NOTIFICATION_READ_RETENTION_DAYS", "30"))
+
+
 class Notification(BaseModel):
-    sender = me.ReferenceField('User', required=True)
+    sender = me.ReferenceField('User')  # None for system notifications such as low_stock
     recipient = me.ReferenceField('User', required=True)
     shop = me.ReferenceField('Shop', required=True)
-    type = me.StringField(required=True, choices=['access_request', 'access_granted', 'access_denied'])
+    type = me.StringField(required=True, choices=['access_request', 'access_granted', 'access_denied', 'low_stock'])
     message = me.StringField(required=True)
     status = me.StringField(required=True, choices=['pending', 'approved', 'rejected'], default='pending')
     created_at = me.DateTimeField(default=datetime.utcnow)
     updated_at = me.DateTimeField(default=datetime.utcnow)
-
-    meta = {'collection': 'notifications'}
+    # Copied in when the notification is created so listing it needs no dereference
+    sender_name = me.StringField()
+    shop_name = me.StringField()
+    read = me.BooleanField(default=False)
+    read_at = me.DateTimeField()
+
+    meta = {
+        'collection': 'notifications',
+        'indexes': [
+            # Serves the inbox listing and the since= cursor used by polling/SSE clients
+            ('recipient', 'created_at'),
+            # Read notifications are deleted READ_RETENTION_DAYS after being read
+            {'fields': ['read_at'], 'expireAfterSeconds': READ_RETENTION_DAYS * 86400},
+        ]
+    }
 
     def __init__(self, *args, **kwargs):
         # Handle reference IDs if provided
@@ -431,17 +811,64 @@ class Notification(BaseModel):
                     kwargs[field] = kwargs.pop(field_id)
         super().__init__(*args, **kwargs)
 
-    def get_serialized(self):
-        data = super().get_serialized()
-        data['sender'] = str(self.sender.id)
-        data['recipient'] = str(self.recipient.id)
-        data['shop'] = str(self.shop.id)
+    def save(self, *args, **kwargs):
+        created = self._created
+        if created:
+            if self.sender and not self.sender_name:
+                self.sender_name = self.sender.name
+            if self.shop and not self.shop_name:
+                self.shop_name = self.shop.name
+        super().save(*args, **kwargs)
+        if created:
+            recipient_id = ref_id(self._data.get('recipient'))
+            User.objects(id=recipient_id).update_one(inc__unread_notifications=1)
+            # Wake this worker's SSE/long-poll listeners for the recipient
+            broker.publish(recipient_id)
+        return self
+
+    @classmethod
+    def serialize(cls, raw):
+        data = to_json_ready(raw)
+        # Notifications created before read tracking existed are unread
+        data.setdefault('read', False)
         return data
 
+    @classmethod
+    def mark_read(cls, user_id, notification_ids=None):
+        """Mark the user's unread notifications (all, or only notification_ids) as read in one update.
+
+        Returns how many were marked. The user's unread counter drops by
+        exactly that many, since already-read notifications never match.
+        """
+        query = cls.objects(recipient=user_id, read__ne=True)
+        if notification_ids is not None:
+            query = query.filter(id__in=notification_ids)
+        marked = query.update(set__read=True, set__read_at=datetime.utcnow())
+        if marked:
+            User.objects(id=user_id).update_one(dec__unread_notifications=marked)
+        return marked
+
     @classmethod
     def get_pending_requests_for_shop(cls, shop_id):
         return cls.objects(shop=shop_id, type='access_request', status='pending')
 
     @classmethod
     def get_notifications_for_user(cls, user_id):
-        return cls.objects(recipient=user_id).order_by('-created_at')
+        return cls.objects(recipient=user_id).order_by('-created_at', '-id')
+
+    @classmethod
+    def get_new_for_user(cls, user_id, after=None, limit=50):
+        """Raw notifications for a user created after the cursor, oldest first.
+
+        `after` is a (created_at, id) pair; id may be None for a plain
+        timestamp. The id breaks ties between notifications created in the
+        same millisecond.
+        """
+        query = cls.objects(recipient=user_id)
+        if after:
+            created_at, notification_id = after
+            newer = me.Q(created_at__gt=created_at)
+            if notification_id:
+                newer |= me.Q(created_at=created_at, id__gt=notification_id)
+            query = query.filter(newer)
+        return list(query.order_by('created_at', 'id').limit(limit).as_pymongo())
@@ -0,0 +1,78 @@
+"""
+Password hashing with configurable cost and bounded verification.
+
+Hashes use PASSWORD_HASH_METHOD (any Werkzeug method string, e.g.
+"scrypt:32768:8:1" or "pbkdf2:sha256:600000"). Hash checks run on a small
+thread pool: hashlib's scrypt/pbkdf2 release the GIL, so at most
+PASSWORD_HASH_WORKERS checks burn CPU at once and a login storm cannot starve
+the other requests in the worker. Checks that would wait longer than
+PASSWORD_QUEUE_TIMEOUT for a slot fail fast with PasswordCheckBusy.
+
+Hashes made with other parameters still verify, and are upgraded to the
+current method after the next successful login (see needs_rehash).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+# Checks allowed to wait for a pool slot; beyond that callers are told to retry
+MAX_QUEUED = HASH_WORKERS * int(os.getenv("PASSWORD_QUEUE_FACTOR", "4"))
+QUEUE_TIMEOUT = float(os.getenv("PASSWORD_QUEUE_TIMEOUT", "5"))
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password")
+_slots = threading.BoundedSemaphore(HASH_WORKERS + MAX_QUEUED)
+
+
+class PasswordCheckBusy(Exception):
+    """Raised when too many password checks are already pending"""
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=HASH_METHOD)
+
+
+@lru_cache(maxsize=1)
+def current_prefix():
+    # Werkzeug fills in default parameters (e.g. "scrypt" -> "scrypt:32768:8:1"),
+    # so take the prefix from a real hash instead of the setting
+    return hash_password("").split("$", 1)[0]
+
+
+def needs_rehash(password_hash):
+    """True if password_hash was made with different parameters than HASH_METHOD"""
+    return password_hash.split("$", 1)[0] != current_prefix()
+
+
+def _run(fn, *args, wait=True):
+    acquired = _slots.acquire(timeout=QUEUE_TIMEOUT) if wait else _slots.acquire(blocking=False)
+    if not acquired:
+        raise PasswordCheckBusy()
+    try:
+        future = _executor.submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def verify_password(password_hash, password):
+    """Check password against password_hash on the bounded pool"""
+    return _run(check_password_hash, password_hash, password).result()
+
+
+def rehash_in_background(password_hash, password, save):
+    """If password_hash is outdated, hash password with the current method and call save(new_hash) off the request"""
+    if not needs_rehash(password_hash):
+        return
+    try:
+        # Never wait for a slot: the login already succeeded and the rehash is optional
+        _run(lambda: save(hash_password(password)), wait=False)
+    except PasswordCheckBusy:
+        # The next login will try again
+        pass
@@ -0,0 +1,180 @@
+"""
+Opt-in sampling profiler for hot routes.
+
+Views decorated with `profiled` are profiled when either:
+
+- the request carries a valid `X-Profile` header, a token signed with
+  PROFILE_SECRET and valid until its embedded expiry (mint one with
+  `flask --app run profile-token`), or
+- a random draw falls under PROFILE_SAMPLE_RATE (0 by default).
+
+A profiled request writes one file to PROFILE_DIR. With pyinstrument
+installed it is a speedscope JSON (open it on https://www.speedscope.app);
+otherwise cProfile's .prof, readable with pstats, snakeviz or flameprof.
+Each worker also keeps the self time of every frame it has profiled, and
+rewrites hot-frames-<pid>.json in the same directory. `flask --app run
+profile-report` merges those into a top-N across workers and requests.
+
+When neither trigger fires, the cost is a header lookup and a random draw.
+At most one request per worker is profiled at a time, and others skip
+profiling rather than wait.
+"""
+import cProfile
+import glob
+import hashlib
+import hmac
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+import click
+from flask import request
+
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:  # pyinstrument is optional, cProfile is the fallback
+    Profiler = None
+
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SECRET = os.getenv("PROFILE_SECRET")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_HEADER = "X-Profile"
+TOP_N = 30
+
+_busy = threading.Lock()
+_hot_frames_lock = threading.Lock()
+# "file:line(function)" -> [self seconds, profiled requests it appeared in]
+_hot_frames = defaultdict(lambda: [0.0, 0])
+
+
+def sign_token(expires_at, secret=None):
+    secret = secret or PROFILE_SECRET
+    signature = hmac.new(secret.encode(), str(expires_at).encode(), hashlib.sha256).hexdigest()
+    return f"{expires_at}.{signature}"
+
+
+def valid_token(token):
+    if not PROFILE_SECRET or not token:
+        return False
+    expires_at, _, _ = token.partition('.')
+    if not expires_at.isdigit() or int(expires_at) < time.time():
+        return False
+    return hmac.compare_digest(token, sign_token(int(expires_at)))
+
+
+def should_profile():
+    if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+        return True
+    return PROFILE_HEADER in request.headers and valid_token(request.headers[PROFILE_HEADER])
+
+
+def _frame_key(file_path, line, function):
+    return f"{file_path}:{line}({function})"
+
+
+def _pyinstrument_frames(frame):
+    """Yield (key, self seconds) for every frame of a pyinstrument call tree"""
+    stack = [frame]
+    while stack:
+        frame = stack.pop()
+        stack.extend(frame.children)
+        if not frame.total_self_time:
+            continue
+        # Self time is reported on a synthetic "[self]" child of the frame that spent it
+        owner = frame.parent if getattr(frame, 'is_synthetic', False) and frame.parent else frame
+        yield _frame_key(owner.file_path_short, owner.line_no, owner.function), frame.total_self_time
+
+
+def _run_profiled(view, args, kwargs):
+    name = f"{int(time.time() * 1000)}-{request.endpoint}-{os.getpid()}"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if Profiler is not None:
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            profiler.stop()
+            path = os.path.join(PROFILE_DIR, f"{name}.speedscope.json")
+            with open(path, 'w') as f:
+                f.write(profiler.output(SpeedscopeRenderer()))
+            root = profiler.last_session.root_frame()
+            _record(_pyinstrument_frames(root) if root else ())
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return view(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}.prof"))
+        stats = pstats.Stats(profiler).stats
+        # stats: (file, line, function) -> (primitive calls, calls, self time, cumulative time, callers)
+        _record((_frame_key(*key), row[2]) for key, row in stats.items() if row[2])
+
+
+def _record(frames):
+    with _hot_frames_lock:
+        for key, seconds in frames:
+            entry = _hot_frames[key]
+            entry[0] += seconds
+            entry[1] += 1
+        snapshot = dict(_hot_frames)
+    path = os.path.join(PROFILE_DIR, f"hot-frames-{os.getpid()}.json")
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def top_frames(n=TOP_N, directory=PROFILE_DIR):
+    """Merge every worker's hot-frame totals and return the n frames with the most self time"""
+    merged = defaultdict(lambda: [0.0, 0])
+    for path in glob.glob(os.path.join(directory, "hot-frames-*.json")):
+        with open(path) as f:
+            for key, (seconds, samples) in json.load(f).items():
+                merged[key][0] += seconds
+                merged[key][1] += samples
+    return sorted(((key, seconds, samples) for key, (seconds, samples) in merged.items()),
+                  key=lambda row: row[1], reverse=True)[:n]
+
+
+def profiled(view):
+    """Route decorator: profile this view when the request is sampled or carries a signed X-Profile token"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not should_profile() or not _busy.acquire(blocking=False):
+            return view(*args, **kwargs)
+        try:
+            return _run_profiled(view, args, kwargs)
+        finally:
+            _busy.release()
+    return wrapper
+
+
+@click.command('profile-token')
+@click.option('--minutes', default=15, show_default=True, help='How long the token stays valid')
+def profile_token_command(minutes):
+    """Print an X-Profile header value that profiles requests to decorated routes."""
+    if not PROFILE_SECRET:
+        raise click.ClickException("PROFILE_SECRET is not set")
+    click.echo(f"{PROFILE_HEADER}: {sign_token(int(time.time()) + minutes * 60)}")
+
+
+@click.command('profile-report')
+@click.option('--top', default=TOP_N, show_default=True)
+@click.option('--dir', 'directory', default=PROFILE_DIR, show_default=True)
+def profile_report_command(top, directory):
+    """Print the frames with the most self time across all profiled requests."""
+    rows = top_frames(top, directory)
+    if not rows:
+        click.echo(f"No profiles in {directory}")
+        return
+    click.echo(f"{'self s':>10} {'seen':>6}  frame")
+    for key, seconds, samples in rows:
+        click.echo(f"{seconds:>10.4f} {samples:>6}  {key}")
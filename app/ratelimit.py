@@ -0,0 +1,167 @@
+"""
+Token-bucket rate limiting for expensive unauthenticated routes.
+
+    @auth_bp.route('login', methods=['POST'])
+    @rate_limit('login', capacity=30, per=60, by=('ip',))
+    @rate_limit('login', capacity=10, per=60, by=('email',))
+    def login(): ...
+
+Each key (client IP, email from the JSON body) gets a bucket of `capacity`
+tokens refilled at `capacity / per` tokens per second. The decorator runs
+before the view, so a throttled request answers 429 with Retry-After without
+touching the database, the password hasher or SMTP. Stacked decorators are
+checked together: a request takes a token from every bucket, or from none
+when any of them is empty, so a rejected request does not drain the others.
+
+The client IP is request.remote_addr. Behind a reverse proxy, set
+TRUSTED_PROXY_COUNT so create_app takes it from X-Forwarded-For instead.
+
+Buckets live in Redis when REDIS_URL is set, so limits are shared by all
+workers, and in an in-process LRU otherwise. Redis errors let the request
+through rather than locking users out.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import jsonify, request
+
+from app.cache import get_redis_client
+
+ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+MEMORY_BUCKETS = int(os.getenv("RATE_LIMIT_MEMORY_BUCKETS", "100000"))
+
+
+class MemoryBuckets:
+    """Thread-safe in-process token buckets; the least recently used are evicted first"""
+
+    def __init__(self, maxsize=MEMORY_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, limits):
+        """Take one token from every (key, capacity, rate) bucket, or from none of them.
+
+        Returns 0 if allowed, else seconds until every bucket has a token.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for key, capacity, rate in limits:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                levels.append(min(capacity, tokens + (now - updated) * rate))
+            wait = max([(1 - tokens) / rate for tokens, (_, _, rate) in zip(levels, limits) if tokens < 1], default=0.0)
+            for tokens, (key, _, _) in zip(levels, limits):
+                self._buckets[key] = (tokens if wait else tokens - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# Refill and take atomically on the server, using the server's clock so
+# web hosts with skewed clocks share buckets consistently. ARGV holds a
+# capacity and a rate per key; tokens are taken from all keys or none.
+TAKE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local tokens = levels[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """Token buckets shared through any Redis-compatible client"""
+
+    def __init__(self, client, prefix="stocksmart:ratelimit:"):
+        self.prefix = prefix
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    def take(self, limits):
+        try:
+            return float(self._take(
+                keys=[self.prefix + key for key, _, _ in limits],
+                args=[value for _, capacity, rate in limits for value in (capacity, rate)]
+            ))
+        except Exception:
+            return 0.0
+
+
+def _build_buckets():
+    client = get_redis_client()
+    if client is not None:
+        return RedisBuckets(client)
+    return MemoryBuckets()
+
+
+buckets = _build_buckets()
+
+
+def client_ip():
+    return request.remote_addr or "unknown"
+
+
+def request_email():
+    data = request.get_json(silent=True)
+    email = data.get('email') if isinstance(data, dict) else None
+    return email.strip().lower() if isinstance(email, str) and email.strip() else None
+
+
+KEY_FUNCTIONS = {'ip': client_ip, 'email': request_email}
+
+
+def rate_limit(name, capacity, per, by=('ip',)):
+    """Route decorator allowing `capacity` requests per `per` seconds for each key kind in `by`"""
+    rules = [(name, kind, capacity, capacity / per) for kind in by]
+
+    def decorator(view):
+        # Stacked on another rate_limit: join its rules so all are checked in one take
+        if hasattr(view, 'rate_limits'):
+            view.rate_limits.extend(rules)
+            return view
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if ENABLED:
+                limits = []
+                for rule_name, kind, rule_capacity, rate in wrapper.rate_limits:
+                    value = KEY_FUNCTIONS[kind]()
+                    if value is not None:
+                        # The {name} hash tag keeps a route's keys in one Redis Cluster slot
+                        limits.append((f"{{{rule_name}}}:{kind}:{value}", rule_capacity, rate))
+                wait = buckets.take(limits) if limits else 0.0
+                if wait > 0:
+                    response = jsonify({"error": "Too many requests, please try again later"})
+                    response.headers['Retry-After'] = str(math.ceil(wait))
+                    return response, 429
+            return view(*args, **kwargs)
+        wrapper.rate_limits = list(rules)
+        return wrapper
+    return decorator
@@ -0,0 +1,141 @@
+"""
+JWT revocation with a per-worker bloom filter in front of the database.
+
+Logging out stores the token's jti in the revoked_tokens collection (TTL
+bounded by the token's own expiry). Every worker keeps a bloom filter of
+revoked jtis and checks it first:
+
+- A jti not in the filter has definitely not been revoked. Almost every
+  request stops there, with no database access.
+- Only the rare positives (revoked tokens plus ~1% false positives) cost
+  an indexed lookup.
+
+The filter is refreshed incrementally. At most every
+REVOCATION_REFRESH_SECONDS one request pulls the revocations newer than
+the last one seen. Revocations made by another worker therefore take
+effect here within that interval, while a worker's own revocations take
+effect immediately. The filter is rebuilt from scratch every
+REVOCATION_REBUILD_SECONDS, because expired jtis cannot be removed from a
+bloom filter.
+"""
+import hashlib
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from app.models import RevokedToken
+
+REFRESH_SECONDS = float(os.getenv("REVOCATION_REFRESH_SECONDS", "5"))
+REBUILD_SECONDS = float(os.getenv("REVOCATION_REBUILD_SECONDS", "3600"))
+BLOOM_CAPACITY = int(os.getenv("REVOCATION_BLOOM_CAPACITY", "100000"))
+BLOOM_ERROR_RATE = 0.01
+# Re-read a little before the newest revocation seen, covering clock skew
+# between app servers and inserts that commit out of order
+REFRESH_OVERLAP = timedelta(seconds=30)
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def _has(self, positions):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def add(self, item):
+        # Refreshes re-read an overlap window, so the same jti is added
+        # repeatedly; count it once or rebuilds would grow the filter for nothing
+        positions = self._positions(item)
+        if self._has(positions):
+            return
+        for position in positions:
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return self._has(self._positions(item))
+
+
+class RevocationList:
+    def __init__(self, capacity=BLOOM_CAPACITY):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._cursor = None
+        self._refreshed_at = 0.0
+        self._rebuilt_at = 0.0
+
+    def _load(self, bloom, since=None):
+        query = RevokedToken.objects(revoked_at__gte=since) if since else RevokedToken.objects
+        for doc in query.only('jti', 'revoked_at').as_pymongo():
+            bloom.add(doc['jti'])
+            if self._cursor is None or doc['revoked_at'] > self._cursor:
+                self._cursor = doc['revoked_at']
+
+    def _rebuild(self):
+        # Grow with the revocation count so the false-positive rate stays bounded
+        if self._bloom is not None and self._bloom.count > self.capacity:
+            self.capacity *= 2
+        bloom = BloomFilter(self.capacity)
+        self._cursor = None
+        self._load(bloom)
+        self._bloom = bloom
+        self._rebuilt_at = time.monotonic()
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        if self._bloom is not None and now - self._refreshed_at < REFRESH_SECONDS:
+            return
+        # One thread refreshes; the others keep using the current filter
+        blocking = self._bloom is None
+        if not self._lock.acquire(blocking=blocking):
+            return
+        try:
+            if self._bloom is None or now - self._rebuilt_at >= REBUILD_SECONDS:
+                self._rebuild()
+            elif now - self._refreshed_at >= REFRESH_SECONDS:
+                self._load(self._bloom, self._cursor - REFRESH_OVERLAP if self._cursor else None)
+            self._refreshed_at = now
+        finally:
+            self._lock.release()
+
+    def revoke(self, jti, expires_at):
+        RevokedToken.revoke(jti, expires_at)
+        self._maybe_refresh()
+        # Refreshes write bits and rebuilds swap the filter under this lock;
+        # unlocked, the bits set here could be overwritten or left on a
+        # filter that is being replaced
+        with self._lock:
+            self._bloom.add(jti)
+
+    def is_revoked(self, jti):
+        self._maybe_refresh()
+        if jti not in self._bloom:
+            return False
+        return RevokedToken.objects(jti=jti).only('id').first() is not None
+
+
+revocation_list = RevocationList()
+
+
+def revoke_token(jwt_payload):
+    """Revoke a decoded JWT until it would have expired anyway"""
+    expires_at = datetime.utcfromtimestamp(jwt_payload['exp']) if 'exp' in jwt_payload \
+        else datetime.utcnow() + timedelta(days=30)
+    revocation_list.revoke(jwt_payload['jti'], expires_at)
+
+
+def is_token_revoked(jwt_header, jwt_payload):
+    """Flask-JWT-Extended token_in_blocklist_loader callback"""
+    return revocation_list.is_revoked(jwt_payload['jti'])
@@ -4,9 +4,12 @@ import pandas as pd
 from prophet import Prophet
 from sklearn.metrics import mean_absolute_error
 import matplotlib.pyplot as plt
+import logging
 import os
+from app.metrics import FORECAST_FIT_DURATION
 
 prophet_bp = Blueprint('prophet', __name__)
+logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Construct the path to the CSV file
@@ -46,17 +49,18 @@ def demand_forecast(store_id, product_id, periods=7, plot=False):
     test = sub_df[-periods:]
 
     if train['y'].notnull().sum() < 2:
-        print(f"Not enough data for store {store_id}")
+        logger.info("Not enough data to forecast", extra={'store_id': store_id, 'product_id': product_id})
         return None
 
     m = Prophet(interval_width = 0.95)
-    m.fit(train)
+    with FORECAST_FIT_DURATION.time():
+        m.fit(train)
     future = m.make_future_dataframe(periods=periods, freq='D')
     forecast = m.predict(future)
     
     merged = forecast[['ds', 'yhat']].merge(test[['ds', 'y']], on='ds', how='inner')
     mae = mean_absolute_error(merged['y'], merged['yhat'])
-    print(f"Store {store_id} - MAE: {mae:.2f}")
+    logger.info("Forecast fitted", extra={'store_id': store_id, 'product_id': product_id, 'mae': round(mae, 2)})
     
     if plot:
         fig = m.plot(forecast)
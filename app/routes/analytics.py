@@ -1,9 +1,16 @@
 from flask import Blueprint, jsonify, request
 from app.models import Transaction, Product, Shop, User
+from app.jobs import STOCK_COUNTERS
+from app.db import replica_reads, reads
+from app.cache import response_cache, make_key
+from app.utils import make_etag, not_modified
+from app.instrumentation import query_budget
+from app.profiling import profiled
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from bson import ObjectId
 from datetime import datetime, timedelta
 from collections import defaultdict
+from functools import wraps
 import calendar
 
 analytics_bp = Blueprint('analytics', __name__)
@@ -15,7 +22,9 @@ def get_shop_or_404(shop_id_str):
     except Exception:
         return None, jsonify({"error": "Invalid shop_id format"}), 400
     
-    shop = Shop.get_by_id(shop_id)
+    # Read from the same connection as the dashboard queries: on a lagging
+    # secondary, data_version then lags along with the data keyed on it
+    shop = reads(Shop)(id=shop_id).first()
     if not shop:
         return None, jsonify({"error": "Shop not found"}), 404
 
@@ -26,63 +35,102 @@ def get_shop_or_404(shop_id_str):
     if not user:
         return None, jsonify({"error": "User not found"}), 401 
 
-    has_access = False
-    if user.role == "owner":
-        # Check if the shop_id is in the owner's list of shops
-        if shop_id in [s.id for s in user.shops]:
-            has_access = True
-    elif user.role == "employee":
-        # Check if the employee is assigned to this shop
-        if user.shop and user.shop.id == shop_id:
-            has_access = True
-    
-    if not has_access:
+    # Owners: one of their shops; employees: the shop they are assigned to
+    if shop_id not in user.accessible_shop_ids():
         return None, jsonify({"error": "Access forbidden: You do not have permission to view analytics for this shop."}), 403
         
     return shop, None, None
 
 
-@analytics_bp.route('/summary_cards/<shop_id_str>', methods=['GET'])
-@jwt_required()
-def get_summary_cards_data(shop_id_str):
-    shop, error_response, status_code = get_shop_or_404(shop_id_str)
-    if error_response:
-        return error_response, status_code
-
-    products_in_shop = Product.objects(shop=shop.id)
-    total_stock = products_in_shop.sum('quantity')
-    
-    low_stock_products_list = [p for p in products_in_shop if p.quantity <= p.threshold]
-    low_stock_count = len(low_stock_products_list)
-    
-    out_of_stock_count = products_in_shop.filter(quantity=0).count()
-    
-    stock_value = 0
-    for p in products_in_shop:
-        stock_value += p.price * p.quantity
-    
-    summary_cards_data = [
-        {"value": str(total_stock), "label": "Total Stock"},
+# Decorator for per-shop dashboard routes: checks access, answers
+# If-None-Match with a 304, then serves the view's data from the response
+# cache. The view receives the Shop and returns plain JSON-ready data;
+# ETags and cache entries are keyed on the shop's data_version so any
+# sale/stock write invalidates them once it reaches the read replica.
+def shop_analytics(view):
+    @wraps(view)
+    def wrapper(shop_id_str):
+        shop, error_response, status_code = get_shop_or_404(shop_id_str)
+        if error_response:
+            return error_response, status_code
+
+        params = request.args.to_dict()
+        # The date is part of the ETag because the charts are relative to today
+        etag = make_etag(view.__name__, shop.id, shop.data_version, datetime.utcnow().date(), sorted(params.items()))
+        cached_response = not_modified(etag)
+        if cached_response:
+            return cached_response
+
+        key = make_key(view.__name__, shop.id, shop.data_version, params)
+        data = response_cache.get(key)
+        if data is None:
+            data = view(shop)
+            response_cache.set(key, data)
+        response = jsonify(data)
+        response.set_etag(etag)
+        return response, 200
+    return wrapper
+
+
+def summary_cards(total_units, low_stock_count, out_of_stock_count, inventory_value):
+    return [
+        {"value": str(total_units), "label": "Total Stock"},
         {"value": str(low_stock_count), "label": "Low Stock"},
         {"value": str(out_of_stock_count), "label": "Out of Stock"},
-        {"value": f"{stock_value:.2f}", "label": "Stock Value (ETB)"},
+        {"value": f"{inventory_value:.2f}", "label": "Stock Value (ETB)"},
     ]
-    return jsonify(summary_cards_data), 200
 
 
-@analytics_bp.route('/pie_chart/stock_by_category/<shop_id_str>', methods=['GET'])
+def monthly_periods(today):
+    """(label, first second, last second) of the six months on the monthly sales chart"""
+    periods = []
+    for i in range(5, -1, -1):
+        target_date = today - timedelta(days=i * 30)
+        month_name = calendar.month_abbr[target_date.month]
+        year_abbr = target_date.strftime("%y")
+
+        first_day_of_month = datetime(target_date.year, target_date.month, 1)
+        if target_date.month == 12:
+            last_day_of_month = datetime(target_date.year, target_date.month, 31, 23, 59, 59)
+        else:
+            last_day_of_month = datetime(target_date.year, target_date.month + 1, 1) - timedelta(seconds=1)
+        periods.append((f"{month_name} '{year_abbr}", first_day_of_month, last_day_of_month))
+    return periods
+
+
+def daily_periods(today):
+    """(label, first second, last second) of the seven days on the daily sales chart"""
+    periods = []
+    for i in range(6, -1, -1):
+        day_date = today - timedelta(days=i)
+        start_of_day = datetime(day_date.year, day_date.month, day_date.day, 0, 0, 0)
+        end_of_day = datetime(day_date.year, day_date.month, day_date.day, 23, 59, 59)
+        periods.append((day_date.strftime("%a"), start_of_day, end_of_day))
+    return periods
+
+
+@analytics_bp.route('/summary_cards/<shop_id_str>', methods=['GET'])
 @jwt_required()
-def get_pie_chart_data(shop_id_str):
-    shop, error_response, status_code = get_shop_or_404(shop_id_str)
-    if error_response:
-        return error_response, status_code
+@replica_reads
+@query_budget(2)
+@shop_analytics
+def get_summary_cards_data(shop):
+    # The shop document carries incrementally maintained counters, so no product scan is needed
+    return summary_cards(shop.total_units, shop.low_stock_count, shop.out_of_stock_count, shop.inventory_value)
+
 
-    products_in_shop = Product.objects(shop=shop.id)
+@analytics_bp.route('/pie_chart/stock_by_category/<shop_id_str>', methods=['GET'])
+@jwt_required()
+@replica_reads
+@query_budget(3)
+@shop_analytics
+def get_pie_chart_data(shop):
+    products_in_shop = reads(Product)(shop=shop.id).only('category', 'quantity').as_pymongo()
     
     category_stock_distribution = defaultdict(int)
     for product in products_in_shop:
-        category_name = product.category if product.category else "Uncategorized"
-        category_stock_distribution[category_name] += product.quantity
+        category_name = product.get('category') or "Uncategorized"
+        category_stock_distribution[category_name] += product.get('quantity', 0)
     
     pie_chart_data = []
     for category, total_quantity in category_stock_distribution.items():
@@ -92,32 +140,20 @@ def get_pie_chart_data(shop_id_str):
                 "population": total_quantity  # "population" here means total quantity in stock for that category
             })
     
-    return jsonify(pie_chart_data), 200
+    return pie_chart_data
 
 
 @analytics_bp.route('/line_chart/monthly_sales/<shop_id_str>', methods=['GET'])
 @jwt_required()
-def get_line_chart_data(shop_id_str):
-    shop, error_response, status_code = get_shop_or_404(shop_id_str)
-    if error_response:
-        return error_response, status_code
-
+@replica_reads
+@query_budget(8)
+@shop_analytics
+def get_line_chart_data(shop):
     line_chart_labels = []
     line_chart_sales_data = []
-    today = datetime.utcnow()
-    for i in range(5, -1, -1): 
-        target_date = today - timedelta(days=i * 30) 
-        month_name = calendar.month_abbr[target_date.month]
-        year_abbr = target_date.strftime("%y")
-        line_chart_labels.append(f"{month_name} '{year_abbr}")
-
-        first_day_of_month = datetime(target_date.year, target_date.month, 1)
-        if target_date.month == 12:
-            last_day_of_month = datetime(target_date.year, target_date.month, 31, 23, 59, 59)
-        else:
-            last_day_of_month = datetime(target_date.year, target_date.month + 1, 1) - timedelta(seconds=1)
-
-        monthly_sales = Transaction.objects(
+    for label, first_day_of_month, last_day_of_month in monthly_periods(datetime.utcnow()):
+        line_chart_labels.append(label)
+        monthly_sales = reads(Transaction)(
             shop=shop.id,
             transaction_type="sale",
             date__gte=first_day_of_month,
@@ -129,27 +165,20 @@ def get_line_chart_data(shop_id_str):
         "labels": line_chart_labels,
         "datasets": [{"data": line_chart_sales_data}]
     }
-    return jsonify(line_chart_data), 200
+    return line_chart_data
 
 
 @analytics_bp.route('/bar_chart/daily_sales/<shop_id_str>', methods=['GET'])
 @jwt_required()
-def get_bar_chart_data(shop_id_str):
-    shop, error_response, status_code = get_shop_or_404(shop_id_str)
-    if error_response:
-        return error_response, status_code
-
+@replica_reads
+@query_budget(9)
+@shop_analytics
+def get_bar_chart_data(shop):
     bar_chart_labels = []
     bar_chart_sales_data = []
-    today = datetime.utcnow()
-    for i in range(6, -1, -1): 
-        day_date = today - timedelta(days=i)
-        bar_chart_labels.append(day_date.strftime("%a")) 
-        
-        start_of_day = datetime(day_date.year, day_date.month, day_date.day, 0, 0, 0)
-        end_of_day = datetime(day_date.year, day_date.month, day_date.day, 23, 59, 59)
-        
-        daily_sales = Transaction.objects(
+    for label, start_of_day, end_of_day in daily_periods(datetime.utcnow()):
+        bar_chart_labels.append(label)
+        daily_sales = reads(Transaction)(
             shop=shop.id,
             transaction_type="sale",
             date__gte=start_of_day,
@@ -161,48 +190,47 @@ def get_bar_chart_data(shop_id_str):
         "labels": bar_chart_labels,
         "datasets": [{"data": bar_chart_sales_data}]
     }
-    return jsonify(bar_chart_data), 200
+    return bar_chart_data
 
 
 @analytics_bp.route('/critical_products/<shop_id_str>', methods=['GET'])
 @jwt_required()
-def get_critical_products_data(shop_id_str):
-    shop, error_response, status_code = get_shop_or_404(shop_id_str)
-    if error_response:
-        return error_response, status_code
-
-    products_in_shop = Product.objects(shop=shop.id)
-    low_stock_products_list = [p for p in products_in_shop if p.quantity <= p.threshold]
+@replica_reads
+@query_budget(3)
+@shop_analytics
+def get_critical_products_data(shop):
+    # Served by the (shop, is_low_stock, -stock_deficit) index, most critical first
+    low_stock_products_list = reads(Product)(shop=shop.id, is_low_stock=True) \
+        .order_by('-stock_deficit').only('name', 'category', 'quantity').as_pymongo()
     
     critical_products_list_data = []
     for p in low_stock_products_list: 
          critical_products_list_data.append({
-            "name": p.name,
-            "category": p.category,
-            "stock": str(p.quantity),
+            "name": p.get('name'),
+            "category": p.get('category'),
+            "stock": str(p.get('quantity', 0)),
             "lowStock": True 
         })
-    return jsonify(critical_products_list_data), 200
+    return critical_products_list_data
 
 
 @analytics_bp.route('/top_selling_products/<shop_id_str>', methods=['GET'])
 @jwt_required()
-def get_top_selling_products_data(shop_id_str):
-    shop, error_response, status_code = get_shop_or_404(shop_id_str)
-    if error_response:
-        return error_response, status_code
-
+@replica_reads
+@query_budget(3)
+@shop_analytics
+def get_top_selling_products_data(shop):
     thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    sales_transactions = Transaction.objects(
+    sales_transactions = reads(Transaction)(
         shop=shop.id, 
         transaction_type="sale",
         date__gte=thirty_days_ago
-    )
+    ).only('payload.name', 'payload.quantity').as_pymongo()
     
     product_units_sold = defaultdict(int)
     for trans in sales_transactions: 
-        for item in trans.payload:
-            product_units_sold[item.name] += item.quantity 
+        for item in trans.get('payload', []):
+            product_units_sold[item['name']] += item['quantity'] 
     
     sorted_top_products = sorted(product_units_sold.items(), key=lambda x: x[1], reverse=True)[:5] 
     
@@ -212,18 +240,17 @@ def get_top_selling_products_data(shop_id_str):
             "name": name,
             "unitsSold": str(units)
         })
-    return jsonify(top_selling_products_list_data), 200
+    return top_selling_products_list_data
 
 
 @analytics_bp.route('/top_stocked_products/<shop_id_str>', methods=['GET'])
 @jwt_required()
-def get_top_stocked_products_data(shop_id_str):
-    shop, error_response, status_code = get_shop_or_404(shop_id_str)
-    if error_response:
-        return error_response, status_code
-
+@replica_reads
+@query_budget(3)
+@shop_analytics
+def get_top_stocked_products_data(shop):
     # Query products for the shop, order by quantity descending, and limit to top 5
-    top_stocked_products = Product.objects(shop=shop.id).order_by('-quantity').limit(5)
+    top_stocked_products = reads(Product)(shop=shop.id).order_by('-quantity').limit(5).only('name', 'category', 'quantity')
 
     top_stocked_products_list_data = []
     for product in top_stocked_products:
@@ -234,11 +261,145 @@ def get_top_stocked_products_data(shop_id_str):
                 "stock": str(product.quantity)
             })
     
-    return jsonify(top_stocked_products_list_data), 200
+    return top_stocked_products_list_data
+
+
+TOP_SELLING_LIMIT = 5
+
+
+def overview_shop_ids(user):
+    """Shops for the overview: the ?shop_ids= subset, or every shop the user can access.
+
+    Returns (shop ids, None) or (None, (error response, status)).
+    """
+    accessible = user.accessible_shop_ids()
+    requested = request.args.get('shop_ids')
+    if not requested:
+        return accessible, None
+    try:
+        shop_ids = list(dict.fromkeys(ObjectId(s.strip()) for s in requested.split(',') if s.strip()))
+    except Exception:
+        return None, (jsonify({"error": "Invalid shop_id format"}), 400)
+    if not set(shop_ids) <= set(accessible):
+        return None, (jsonify({"error": "Access forbidden: You do not have permission to view analytics for this shop."}), 403)
+    return shop_ids, None
+
+
+def sales_by_shop(shop_ids, months, days, top_since):
+    """Sales of every shop for the line chart months, bar chart days and top sellers, in one aggregation.
+
+    Returns {'monthly': {(shop, 'YYYY-MM'): total}, 'daily': {(shop, 'YYYY-MM-DD'): total},
+    'units': {(shop, product name): units sold since top_since}}.
+    """
+    def group_by_period(date_format):
+        return {'$group': {
+            '_id': {'shop': '$shop', 'period': {'$dateToString': {'format': date_format, 'date': '$date'}}},
+            'total': {'$sum': '$total'},
+        }}
+
+    since = min(months[0][1], days[0][1], top_since)
+    pipeline = [
+        {'$match': {'shop': {'$in': shop_ids}, 'transaction_type': 'sale',
+                    'date': {'$gte': since, '$lte': max(months[-1][2], days[-1][2])}}},
+        {'$facet': {
+            'monthly': [{'$match': {'date': {'$gte': months[0][1]}}}, group_by_period('%Y-%m')],
+            'daily': [{'$match': {'date': {'$gte': days[0][1]}}}, group_by_period('%Y-%m-%d')],
+            'units': [
+                {'$match': {'date': {'$gte': top_since}}},
+                {'$unwind': '$payload'},
+                {'$group': {'_id': {'shop': '$shop', 'period': '$payload.name'}, 'total': {'$sum': '$payload.quantity'}}},
+            ],
+        }},
+    ]
+    facets = next(iter(reads(Transaction).aggregate(pipeline)), {})
+    return {
+        name: {(row['_id']['shop'], row['_id']['period']): row['total'] for row in facets.get(name, [])}
+        for name in ('monthly', 'daily', 'units')
+    }
+
+
+def shop_dashboard(counters, sales, shop_ids, months, days):
+    """Summary cards, sales charts and top sellers of one shop, or of several added together"""
+    def series(periods, totals, date_format):
+        return {
+            "labels": [label for label, _, _ in periods],
+            "datasets": [{"data": [
+                sum(totals.get((shop_id, first.strftime(date_format)), 0) for shop_id in shop_ids)
+                for _, first, _ in periods
+            ]}],
+        }
+
+    units = defaultdict(int)
+    for (shop_id, name), sold in sales['units'].items():
+        if shop_id in shop_ids:
+            units[name] += sold
+    top_selling = sorted(units.items(), key=lambda x: x[1], reverse=True)[:TOP_SELLING_LIMIT]
+    return {
+        "summary_cards": summary_cards(counters['total_units'], counters['low_stock_count'],
+                                       counters['out_of_stock_count'], counters['inventory_value']),
+        "monthly_sales": series(months, sales['monthly'], '%Y-%m'),
+        "daily_sales": series(days, sales['daily'], '%Y-%m-%d'),
+        "top_selling_products": [{"name": name, "unitsSold": str(sold)} for name, sold in top_selling],
+    }
+
+
+# Every dashboard figure for several shops at once: the summary cards, the
+# monthly and daily sales charts and the top sellers, per shop and
+# consolidated. Costs three queries whatever the number of shops (the user,
+# the shops' counters, one aggregation over their transactions), where the
+# per-shop routes cost one request and several queries per shop and chart.
+@analytics_bp.route('/overview', methods=['GET'])
+@jwt_required()
+@replica_reads
+@query_budget(3)
+def get_shops_overview():
+    user = User.get_by_email(get_jwt_identity())
+    if not user:
+        return jsonify({"error": "User not found"}), 401
+
+    shop_ids, error = overview_shop_ids(user)
+    if error:
+        return error
+    shops = sorted(
+        reads(Shop)(id__in=shop_ids).only('name', 'data_version', *STOCK_COUNTERS).as_pymongo(),
+        key=lambda shop: shop.get('name') or ''
+    )
+
+    # Any sale or stock write in one of the shops changes its data_version
+    versions = sorted((str(shop['_id']), shop.get('data_version', 0)) for shop in shops)
+    etag = make_etag('get_shops_overview', versions, datetime.utcnow().date())
+    cached_response = not_modified(etag)
+    if cached_response:
+        return cached_response
+
+    key = make_key('get_shops_overview', ','.join(shop_id for shop_id, _ in versions), etag)
+    data = response_cache.get(key)
+    if data is None:
+        today = datetime.utcnow()
+        months, days = monthly_periods(today), daily_periods(today)
+        ids = [shop['_id'] for shop in shops]
+        sales = sales_by_shop(ids, months, days, today - timedelta(days=30)) if ids else {'monthly': {}, 'daily': {}, 'units': {}}
+
+        counters = {shop['_id']: {field: shop.get(field, 0) for field in STOCK_COUNTERS} for shop in shops}
+        totals = {field: sum(c[field] for c in counters.values()) for field in STOCK_COUNTERS}
+        data = {
+            "shops": [
+                {"shop_id": str(shop['_id']), "name": shop.get('name'),
+                 **shop_dashboard(counters[shop['_id']], sales, {shop['_id']}, months, days)}
+                for shop in shops
+            ],
+            "consolidated": shop_dashboard(totals, sales, set(ids), months, days),
+        }
+        response_cache.set(key, data)
+    response = jsonify(data)
+    response.set_etag(etag)
+    return response, 200
 
 
 @analytics_bp.route('/product_sales/<shop_id_str>', methods=['GET'])
 @jwt_required()
+@replica_reads
+@profiled
 def get_product_sales_analytics(shop_id_str):
     try:
         shop_id = ObjectId(shop_id_str)
@@ -256,17 +417,8 @@ def get_product_sales_analytics(shop_id_str):
     if not user:
         return jsonify({"error": "User not found"}), 401 
 
-    has_access = False
-    if user.role == "owner":
-        # Check if the shop_id is in the owner's list of shops
-        if shop_id in [s.id for s in user.shops]:
-            has_access = True
-    elif user.role == "employee":
-        # Check if the employee is assigned to this shop
-        if user.shop and user.shop.id == shop_id:
-            has_access = True
-    
-    if not has_access:
+    # Owners: one of their shops; employees: the shop they are assigned to
+    if shop_id not in user.accessible_shop_ids():
         return jsonify({"error": "Access forbidden: You do not have permission to view analytics for this shop."}), 403
 
     # Get query parameters
@@ -303,31 +455,32 @@ def get_product_sales_analytics(shop_id_str):
     }
 
     # Get transactions
-    transactions = Transaction.objects(**query)
+    transactions = reads(Transaction)(**query).only('date', 'payload.product_id', 'payload.name', 'payload.quantity').as_pymongo()
 
     # Initialize data structure for sales
     sales_data = defaultdict(lambda: defaultdict(int))
 
     # Process transactions
     for transaction in transactions:
-        for item in transaction.payload:
-            if product_id and str(item.product_id) != product_id:
+        transaction_date = transaction['date']
+        for item in transaction.get('payload', []):
+            if product_id and str(item['product_id']) != product_id:
                 continue
 
             # Get the appropriate time key based on granularity
             if granularity == 'daily':
-                time_key = transaction.date.strftime('%Y-%m-%d')
+                time_key = transaction_date.strftime('%Y-%m-%d')
             elif granularity == 'weekly':
                 # Get the start of the week (Monday)
-                week_start = transaction.date - timedelta(days=transaction.date.weekday())
+                week_start = transaction_date - timedelta(days=transaction_date.weekday())
                 time_key = week_start.strftime('%Y-%m-%d')
             elif granularity == 'monthly':
-                time_key = transaction.date.strftime('%Y-%m')
+                time_key = transaction_date.strftime('%Y-%m')
             else:  # annual
-                time_key = transaction.date.strftime('%Y')
+                time_key = transaction_date.strftime('%Y')
 
             # Add to sales data
-            sales_data[time_key][item.name] += item.quantity
+            sales_data[time_key][item['name']] += item['quantity']
 
     # Format response
     response_data = []
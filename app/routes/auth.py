@@ -1,15 +1,19 @@
 from flask import Blueprint, request, jsonify, render_template_string
-from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity, unset_jwt_cookies
+from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity, unset_jwt_cookies, get_jwt, decode_token
 from app.models import PasswordResetToken, User
+from app.passwords import PasswordCheckBusy
+from app.ratelimit import rate_limit
+from app.revocation import revoke_token
 from app.utils import generate_otp_secret, generate_otp_token,send_email, send_email, send_password_reset_email 
+import logging
 import pyotp  
 
 auth_bp = Blueprint('auth', __name__)
+logger = logging.getLogger(__name__)
 
 @auth_bp.route('signup', methods=['POST'])
 def signup():
     data = request.get_json()
-    print(f"Received data: {data}")  
     name = data.get('name')
     email = data.get('email')
     password = data.get('password')
@@ -24,7 +28,7 @@ def signup():
         if not password:
             missing_fields.append("password")
 
-        print(f"Missing fields: {missing_fields}")  
+        logger.info("Signup rejected", extra={'missing_fields': missing_fields})
         return jsonify({"error": "Missing required fields", "missing_fields": missing_fields}), 400
 
     existing_user = User.get_by_email(email)
@@ -38,6 +42,8 @@ def signup():
 
 
 @auth_bp.route('login', methods=['POST'])
+@rate_limit('login', capacity=30, per=60, by=('ip',))
+@rate_limit('login', capacity=10, per=60, by=('email',))
 def login():
     data = request.get_json()
     email = data.get('email')
@@ -47,7 +53,15 @@ def login():
         return jsonify({"error": "Missing required fields"}), 400
 
     user = User.get_by_email(email)
-    if user and user.check_password(password):
+    try:
+        password_ok = user is not None and user.check_password(password)
+    except PasswordCheckBusy:
+        response = jsonify({"error": "Too many login attempts in progress, please retry"})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+    if password_ok:
+        user.upgrade_password_hash(password)
         access_token = create_access_token(identity=user.email)
         refresh_token = create_refresh_token(identity=user.email)
         return jsonify(access_token=access_token, refresh_token=refresh_token, user=user.get_serialized()), 200
@@ -64,6 +78,8 @@ def refresh():
 
 
 @auth_bp.route("send-otp", methods=["POST"])
+@rate_limit('send-otp', capacity=10, per=600, by=('ip',))
+@rate_limit('send-otp', capacity=3, per=600, by=('email',))
 def send_otp():
     data = request.get_json()
     email = data.get("email")
@@ -110,6 +126,8 @@ def verify_otp():
 
 
 @auth_bp.route('/forgot-password', methods=['POST'])
+@rate_limit('forgot-password', capacity=10, per=600, by=('ip',))
+@rate_limit('forgot-password', capacity=3, per=3600, by=('email',))
 def forgot_password():
     data = request.get_json()
     email = data.get('email')
@@ -131,9 +149,9 @@ def forgot_password():
 
     try:
         send_password_reset_email(user.email, reset_link)
-    except Exception as e:
+    except Exception:
         # Log the error, but still return a generic message to the user
-        print(f"Error sending password reset email: {e}")
+        logger.exception("Error sending password reset email")
         return jsonify({"message": "If an account with this email exists, a password reset link has been sent."}), 200
         
     return jsonify({"message": "If an account with this email exists, a password reset link has been sent."}), 200
@@ -217,18 +235,14 @@ def reset_password_with_token(token):
     if len(new_password) < 6: 
         return jsonify({"error": "Password must be at least 6 characters long"}), 400
 
-    token_doc = PasswordResetToken.get_by_token(token)
+    # Checks expiry and deletes the token in one round trip, so it can only be used once
+    token_doc = PasswordResetToken.consume(token)
 
     if not token_doc:
         return jsonify({"error": "Invalid or expired reset token"}), 400
-    
-    if token_doc.is_expired():
-        token_doc.delete() 
-        return jsonify({"error": "Invalid or expired reset token"}), 400 
 
     user = token_doc.user
     if not user:
-        token_doc.delete() 
         return jsonify({"error": "User not found for this token"}), 404
 
     user.password_hash = "" 
@@ -236,14 +250,24 @@ def reset_password_with_token(token):
     user.password_hash = user_temp_for_hashing.password_hash
     user.save()
 
-    token_doc.delete()
-
     return jsonify({"message": "Password has been reset successfully."}), 200
 
 
 @auth_bp.route('/logout', methods=['POST'])
 @jwt_required()
 def logout():
+    revoke_token(get_jwt())
+
+    # The refresh token would otherwise keep minting access tokens
+    refresh_token = (request.get_json(silent=True) or {}).get('refresh_token')
+    if refresh_token:
+        try:
+            refresh_payload = decode_token(refresh_token)
+        except Exception:
+            return jsonify({"error": "Invalid refresh token"}), 400
+        if refresh_payload.get('sub') == get_jwt_identity():
+            revoke_token(refresh_payload)
+
     response = jsonify({"message": "Successfully logged out"})
     unset_jwt_cookies(response)
     return response, 200
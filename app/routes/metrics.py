@@ -0,0 +1,17 @@
+from flask import Blueprint, Response, jsonify, request
+from app import metrics
+import hmac
+import os
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# When set, scrapers must send "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
@@ -1,10 +1,75 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from app.models import Notification, Shop, User
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from datetime import datetime
+from app.broker import broker
+from flask_jwt_extended import jwt_required, get_jwt, get_jwt_identity, get_jwt_request_location, create_access_token
+from bson import ObjectId
+from datetime import datetime, timedelta
+import os
+import time
 
 notification_bp = Blueprint('notifications', __name__)
 
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+# How often listeners re-check the database for notifications created by other workers
+CHECK_INTERVAL = float(os.getenv("NOTIFICATION_CHECK_SECONDS", "5"))
+# Streams end after this long and the client reconnects with Last-Event-ID,
+# so a worker thread is never pinned indefinitely
+STREAM_MAX_SECONDS = int(os.getenv("NOTIFICATION_STREAM_MAX_SECONDS", "300"))
+KEEPALIVE_SECONDS = 15
+MAX_POLL_TIMEOUT = 55
+# EventSource cannot send headers, so the stream takes ?jwt=. Only tokens with
+# this scope are accepted there, and they open nothing but the stream: a URL
+# that ends up in proxy or access logs never carries a real access token.
+STREAM_TOKEN_SCOPE = 'notifications:stream'
+STREAM_TOKEN_SECONDS = int(os.getenv("NOTIFICATION_STREAM_TOKEN_SECONDS", "60"))
+STREAM_ENDPOINT = 'notifications.stream_notifications'
+
+
+def stream_token_allowed(jwt_header, jwt_data):
+    """token_verification_loader callback: stream-scoped tokens are only valid on the stream"""
+    scope = jwt_data.get('scope')
+    return scope is None or (scope == STREAM_TOKEN_SCOPE and request.endpoint == STREAM_ENDPOINT)
+
+
+def parse_limit():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    return min(max(limit, 1), MAX_LIMIT)
+
+
+def parse_since(value):
+    """Turn a since cursor (a notification id or an ISO 8601 timestamp) into a (created_at, id) pair"""
+    if ObjectId.is_valid(value):
+        anchor = Notification.objects(id=value).only('created_at').as_pymongo().first()
+        if not anchor:
+            raise ValueError("Unknown notification id")
+        return anchor['created_at'], ObjectId(value)
+    return datetime.fromisoformat(value.replace('Z', '+00:00')), None
+
+
+def cursor_after(rows, cursor):
+    """The cursor following the last of the rows just sent"""
+    if rows:
+        return rows[-1]['created_at'], rows[-1]['_id']
+    return cursor
+
+
+def wait_for_notifications(user_id, cursor, limit, timeout):
+    """Return notifications after the cursor, waiting up to timeout seconds for the first one"""
+    deadline = time.monotonic() + timeout
+    with broker.listen(user_id) as published:
+        while True:
+            published.clear()
+            rows = Notification.get_new_for_user(user_id, cursor, limit)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                return rows
+            published.wait(min(remaining, CHECK_INTERVAL))
+
+
 @notification_bp.route('/notifications', methods=['GET'])
 @jwt_required()
 def get_notifications():
@@ -13,9 +78,158 @@ def get_notifications():
     
     if not user:
         return jsonify({"error": "User not found"}), 404
-    
-    notifications = Notification.get_notifications_for_user(user.id)
-    return jsonify([notif.get_serialized() for notif in notifications]), 200
+
+    limit = parse_limit()
+    since = request.args.get('since')
+    if since:
+        # Only what is new since the client's last fetch, oldest first
+        try:
+            rows = Notification.get_new_for_user(user.id, parse_since(since), limit)
+        except ValueError as e:
+            return jsonify({"error": f"Invalid since cursor: {e}"}), 400
+    else:
+        rows = Notification.get_notifications_for_user(user.id).limit(limit).as_pymongo()
+    return jsonify([Notification.serialize(raw) for raw in rows]), 200
+
+
+@notification_bp.route('/notifications/inbox', methods=['GET'])
+@jwt_required()
+def get_inbox():
+    """One page of the user's notifications, newest first, with the unread count"""
+    email = get_jwt_identity()
+    user = User.get_by_email(email)
+
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('per_page', 20))
+    except ValueError:
+        return jsonify({"error": "Invalid page or per_page parameter"}), 400
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), 100)
+
+    query = Notification.get_notifications_for_user(user.id)
+    if request.args.get('unread', 'false').lower() == 'true':
+        query = query.filter(read__ne=True)
+    # One extra row tells whether there is a next page without counting the inbox
+    rows = list(query.skip((page - 1) * per_page).limit(per_page + 1).as_pymongo())
+
+    return jsonify({
+        "notifications": [Notification.serialize(raw) for raw in rows[:per_page]],
+        "unread_count": user.unread_notifications,
+        "page": page,
+        "per_page": per_page,
+        "has_next": len(rows) > per_page,
+        "has_prev": page > 1
+    }), 200
+
+
+@notification_bp.route('/notifications/read', methods=['POST'])
+@jwt_required()
+def mark_notifications_read():
+    """Mark notifications as read: {"ids": [...]} for specific ones or {"all": true} for the whole inbox"""
+    email = get_jwt_identity()
+    user = User.get_by_email(email)
+
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    data = request.get_json(silent=True) or {}
+    if data.get('all'):
+        notification_ids = None
+    else:
+        ids = data.get('ids')
+        if not isinstance(ids, list) or not ids:
+            return jsonify({"error": "Provide a non-empty 'ids' list or 'all': true"}), 400
+        if not all(ObjectId.is_valid(i) for i in ids):
+            return jsonify({"error": "Invalid notification id format"}), 400
+        notification_ids = [ObjectId(i) for i in ids]
+
+    marked = Notification.mark_read(user.id, notification_ids)
+    unread = User.objects(id=user.id).only('unread_notifications').as_pymongo().first()
+    return jsonify({"marked": marked, "unread_count": unread.get('unread_notifications', 0)}), 200
+
+
+@notification_bp.route('/notifications/poll', methods=['GET'])
+@jwt_required()
+def poll_notifications():
+    """Long-poll fallback for clients without SSE: answers as soon as something new arrives"""
+    email = get_jwt_identity()
+    user = User.get_by_email(email)
+
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    try:
+        since = request.args.get('since')
+        cursor = parse_since(since) if since else (datetime.utcnow(), None)
+        timeout = min(max(float(request.args.get('timeout', 25)), 0), MAX_POLL_TIMEOUT)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid since cursor or timeout: {e}"}), 400
+
+    rows = wait_for_notifications(user.id, cursor, parse_limit(), timeout)
+    return jsonify([Notification.serialize(raw) for raw in rows]), 200
+
+
+@notification_bp.route('/notifications/stream-token', methods=['POST'])
+@jwt_required()
+def create_stream_token():
+    """A short-lived token that only opens /notifications/stream, for its ?jwt= parameter"""
+    token = create_access_token(
+        identity=get_jwt_identity(),
+        expires_delta=timedelta(seconds=STREAM_TOKEN_SECONDS),
+        additional_claims={'scope': STREAM_TOKEN_SCOPE}
+    )
+    return jsonify({"token": token, "expires_in": STREAM_TOKEN_SECONDS}), 201
+
+
+@notification_bp.route('/notifications/stream', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def stream_notifications():
+    """Server-sent events: one `notification` event per new notification.
+
+    Resumes after the Last-Event-ID header (or since=) when reconnecting,
+    otherwise starts with notifications created from now on. Clients that
+    cannot set headers pass a token from /notifications/stream-token as ?jwt=.
+    """
+    if get_jwt_request_location() == 'query_string' and get_jwt().get('scope') != STREAM_TOKEN_SCOPE:
+        return jsonify({"error": "Pass a token from POST /notifications/stream-token in ?jwt=, not an access token"}), 401
+
+    email = get_jwt_identity()
+    user = User.get_by_email(email)
+
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        cursor = parse_since(since) if since else (datetime.utcnow(), None)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid since cursor: {e}"}), 400
+
+    json = current_app.json
+    user_id = user.id
+
+    def events(cursor):
+        yield "retry: 3000\n\n"
+        end = time.monotonic() + STREAM_MAX_SECONDS
+        while time.monotonic() < end:
+            rows = wait_for_notifications(user_id, cursor, MAX_LIMIT, min(KEEPALIVE_SECONDS, end - time.monotonic()))
+            if not rows:
+                # Comment line: keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                continue
+            for raw in rows:
+                yield f"id: {raw['_id']}\nevent: notification\ndata: {json.dumps(Notification.serialize(raw))}\n\n"
+            cursor = cursor_after(rows, cursor)
+
+    return Response(
+        stream_with_context(events(cursor)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @notification_bp.route('/shop/<shop_id>/request-access', methods=['POST'])
 @jwt_required()
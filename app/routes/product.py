@@ -1,17 +1,32 @@
 from flask import Blueprint, request, jsonify
-from app.models import Product, Item, Transaction, Shop, User, RestockItemPayload, SaleItemPayload
+from app.models import Product, Item, Transaction, Shop, User, RestockItemPayload, SaleItemPayload, PRODUCT_SAVE_ATTEMPTS
 from flask_jwt_extended import jwt_required
 from flask_jwt_extended import get_jwt_identity
 from bson import ObjectId
 import cloudinary
 from app import utils  
+from app.serialization import requested_fields
+from app.instrumentation import query_budget
+from app.metrics import record_sale, record_restock
+from app.profiling import profiled
+from app.idempotency import idempotent
+from app import sync
+from collections import Counter
+from mongoengine.errors import NotUniqueError, SaveConditionError
+import logging
 
 product_bp = Blueprint('products', __name__)
+logger = logging.getLogger(__name__)
+
+# Fields returned by the product listing, and the ones `?fields=` may ask for
+PRODUCT_LIST_FIELDS = ('name', 'shop_id', 'price', 'quantity', 'threshold', 'description', 'category', 'image_url')
+PRODUCT_FIELDS = PRODUCT_LIST_FIELDS + ('isSerialized', 'version')
 
 
 #Get all products routes
 @product_bp.route('/', methods=['GET'])
 @jwt_required()
+@query_budget(3)
 def get_all_products():
     shop_id = request.args.get('shop_id')
     if not shop_id:
@@ -30,31 +45,31 @@ def get_all_products():
     if per_page > 100: # Optional: limit max items per page
         per_page = 100
 
-    products_query = Product.objects(shop=ObjectId(shop_id))
+    try:
+        shop_id = ObjectId(shop_id)
+    except Exception:
+        return jsonify({"error": "Invalid shop_id format"}), 400
+
+    fields = requested_fields(PRODUCT_LIST_FIELDS, PRODUCT_FIELDS, aliases={'shop_id': 'shop'})
+
+    # Any product/stock write bumps the shop version, so it stands in for the page contents
+    etag = utils.make_etag('products', shop_id, Shop.get_data_version(shop_id), page, per_page, fields)
+    cached_response = utils.not_modified(etag)
+    if cached_response:
+        return cached_response
+
+    products_query = Product.objects(shop=shop_id)
     total_products = products_query.count()
     
     # Calculate skip and limit for pagination
     skip = (page - 1) * per_page
-    paginated_products = products_query.skip(skip).limit(per_page)
+    paginated_products = products_query.skip(skip).limit(per_page).only(*fields).as_pymongo()
 
-    product_list = [
-        {
-            "id": str(product.id),
-            "name": product.name,
-            "shop_id": str(product.shop.id),
-            "price": product.price,
-            "quantity": product.quantity,
-            "threshold": product.threshold,
-            "description": product.description,
-            "category": product.category,
-            "image_url": product.image_url  # Added image_url
-        }
-        for product in paginated_products
-    ]
+    product_list = [Product.serialize(product, fields=fields) for product in paginated_products]
 
     total_pages = (total_products + per_page - 1) // per_page # Ceiling division
 
-    return jsonify({
+    response = jsonify({
         "products": product_list,
         "page": page,
         "per_page": per_page,
@@ -62,7 +77,9 @@ def get_all_products():
         "total_pages": total_pages,
         "has_next": page < total_pages,
         "has_prev": page > 1
-    }), 200
+    })
+    response.set_etag(etag)
+    return response, 200
 
 
 
@@ -70,17 +87,32 @@ def get_all_products():
 @product_bp.route('/<product_id>', methods=['GET'])
 @jwt_required()
 def get_product_by_id(product_id):
+    try:
+        shop_id = Product.get_shop_id(product_id)
+    except Exception:
+        shop_id = None
+    if not shop_id:
+        return jsonify({"error": "Product not found"}), 404
+
+    etag = utils.make_etag('product', product_id, Shop.get_data_version(shop_id))
+    cached_response = utils.not_modified(etag)
+    if cached_response:
+        return cached_response
+
     product = Product.get_by_id(product_id)
     if not product:
         return jsonify({"error": "Product not found"}), 404
 
-    return jsonify(product=product.get_serialized()), 200
+    response = jsonify(product=product.get_serialized())
+    response.set_etag(etag)
+    return response, 200
 
 
 
 #Get all product by barcode route
 @product_bp.route('/barcode/<barcode>', methods=['GET'])
 @jwt_required()
+@profiled
 def get_product_by_barcode(barcode):
     shop_id = request.args.get('shop_id')
 
@@ -97,7 +129,8 @@ def get_product_by_barcode(barcode):
     if not matching:
         return jsonify({"error": "Product not found"}), 404
     
-    print(matching)
+    # High volume; DEBUG records are sampled (LOG_DEBUG_SAMPLE_RATE)
+    logger.debug("Barcode lookup", extra={'matches': len(matching), 'shop_id': shop_id})
 
     return jsonify(matching), 200
 
@@ -159,19 +192,31 @@ def add_product():
 @jwt_required()
 def update_product(product_id):
     data = request.get_json()
-    product = Product.get_by_id(product_id)
+
+    def apply_changes(product):
+        product.name = data.get('name', product.name)
+        product.price = data.get('price', product.price)
+        product.quantity = data.get('quantity', product.quantity)
+        product.threshold = data.get('threshold', product.threshold)
+        product.description = data.get('description', product.description)
+        product.category = data.get('category', product.category)
+
+    expected_version = data.get('version')
+    if expected_version is not None and not isinstance(expected_version, int):
+        return jsonify({"error": "version must be an integer"}), 400
+
+    # Clients that send the version they read get a 409 instead of overwriting newer stock.
+    # An absolute quantity is only right for the stock it was computed from, so it is
+    # never retried against a product that changed in between
+    attempts = 1 if 'quantity' in data else PRODUCT_SAVE_ATTEMPTS
+    try:
+        product = Product.update_with_retry(product_id, apply_changes, expected_version=expected_version, attempts=attempts)
+    except SaveConditionError:
+        return jsonify({"error": "Product was changed by another request; reload it and try again"}), 409
     if not product:
         return jsonify({"error": "Product not found"}), 404
 
-    product.name = data.get('name', product.name)
-    product.price = data.get('price', product.price)
-    product.quantity = data.get('quantity', product.quantity)
-    product.threshold = data.get('threshold', product.threshold)
-    product.description = data.get('description', product.description)
-    product.category = data.get('category', product.category)
-    product.save()
-
-    return jsonify({"message": "Product updated successfully"}), 200
+    return jsonify({"message": "Product updated successfully", "version": product.version}), 200
 
 
 
@@ -190,6 +235,8 @@ def delete_product(product_id):
 # Restock route
 @product_bp.route('/restock', methods=['POST'])
 @jwt_required()
+@idempotent
+@profiled
 def restock():
     data = request.get_json()
     shop_id = data.get('shop_id')
@@ -222,14 +269,19 @@ def restock():
     )
 
     if product.isSerialized:
-        for barcode in barcodes:
-            new_item = Item(barcode=barcode, product=product)
-            new_item.save() 
+        added = []
+        try:
+            for barcode in barcodes:
+                Item(barcode=barcode, product=product).save()
+                added.append(barcode)
+        except NotUniqueError:
+            Item.remove_barcodes(product.id, added)
+            return jsonify({"error": f"An item with barcode {barcode} already exists"}), 400
         restock_payload_item.barcodes = barcodes
     else:
         quantity = int(quantity)
-        product.quantity += quantity
-        product.save()
+        # $inc, so concurrent sales are never overwritten
+        Product.adjust_quantity(product.id, quantity)
         restock_payload_item.quantity = quantity
 
     transaction = Transaction(
@@ -242,20 +294,22 @@ def restock():
     try:
         transaction.save()
     except Exception as e:
-        print(f"Transaction save error: {e}")
+        logger.exception("Restock transaction save failed", extra={'product_id': str(product.id)})
         if product.isSerialized:
-            Item.objects(product=product, barcode__in=barcodes).delete()
+            Item.remove_barcodes(product.id, barcodes)
         else:
-            product.quantity -= quantity
-            product.save()
+            Product.adjust_quantity(product.id, -quantity)
         return jsonify({"error": f"Transaction Failed: {str(e)}"}), 400
 
+    record_restock(len(barcodes) if product.isSerialized else quantity)
     return jsonify({"message": "Product restocked successfully", "transaction_id": str(transaction.id)}), 201
 
 
 # Sell route
 @product_bp.route('/sell', methods=['POST'])
 @jwt_required()
+@idempotent
+@profiled
 def sell():
     data = request.get_json()
     shop_id = data.get('shop_id')
@@ -311,11 +365,10 @@ def sell():
                 
                 current_item_barcodes_sold = barcodes_from_cart
                 for barcode in barcodes_from_cart:
-                    item_to_sell = Item.objects(barcode=barcode, product=product).first()
-                    if not item_to_sell:
+                    # Found and removed in one step, so two sales of the same barcode cannot both succeed;
+                    # this also decrements product.quantity
+                    if not Item.take(barcode, product.id):
                         raise ValueError(f"Item with barcode {barcode} not found, does not belong to product {product.name}, or already sold.")
-                    
-                    item_to_sell.delete() # This also decrements product.quantity via Item.delete()
                     committed_stock_changes_for_rollback.append({
                         'type': 'serialized_item_deleted',
                         'barcode': barcode,
@@ -325,7 +378,9 @@ def sell():
                 if product.quantity < quantity_sold:
                     raise ValueError(f"Insufficient stock for {product.name}. Available: {product.quantity}, Requested: {quantity_sold}.")
                 
-                Product.objects(id=product.id).update_one(dec__quantity=quantity_sold)
+                # The check above read a snapshot; the decrement only applies if the stock is still there
+                if Product.adjust_quantity(product.id, -quantity_sold, only_if_available=True) is None:
+                    raise ValueError(f"Insufficient stock for {product.name}: it was sold by another request. Requested: {quantity_sold}.")
                 committed_stock_changes_for_rollback.append({
                     'type': 'nonserialized_product_decremented',
                     'product_id': str(product.id),
@@ -352,6 +407,7 @@ def sell():
         )
         
         transaction.save() # This will also run transaction.clean()
+        record_sale(transaction)
 
         return jsonify({"message": "Items sold successfully", "transaction_id": str(transaction.id)}), 201
 
@@ -366,10 +422,10 @@ def sell():
                         reverted_item = Item(barcode=change['barcode'], product=prod_for_rollback)
                         reverted_item.save()
                 elif change['type'] == 'nonserialized_product_decremented':
-                    Product.objects(id=change['product_id']).update_one(inc__quantity=change['quantity'])
-            except Exception as rollback_e:
+                    Product.adjust_quantity(change['product_id'], change['quantity'])
+            except Exception:
                 # Log rollback error, as the state might be inconsistent
-                print(f"Critical error during rollback: {rollback_e}")
+                logger.exception("Sale rollback failed", extra={'change': change})
         
         error_message = str(e)
         if isinstance(e, ValueError): # Custom validation errors
@@ -378,10 +434,47 @@ def sell():
         elif "ValidationError" in type(e).__name__ : # A bit fragile, but captures mongoengine.errors.ValidationError
             return jsonify({"error": f"Transaction data invalid: {error_message}"}), 400
         else: # Other unexpected errors
-            print(f"Unexpected error during sale: {e}") # Log for server admin
+            logger.exception("Unexpected error during sale", extra={'shop_id': shop_id}) # Log for server admin
             return jsonify({"error": "Sale failed due to an unexpected error. Stock changes have been reverted."}), 500
 
 
+# Upload sales recorded offline
+@product_bp.route('/sync', methods=['POST'])
+@jwt_required()
+def sync_offline_sales():
+    data = request.get_json(silent=True) or {}
+    shop_id = data.get('shop_id')
+    sales = data.get('sales')
+
+    if not shop_id or not isinstance(sales, list) or not sales:
+        return jsonify({"error": "shop_id and a non-empty list of sales are required"}), 400
+    if len(sales) > sync.MAX_SALES:
+        return jsonify({"error": f"At most {sync.MAX_SALES} sales per upload"}), 400
+
+    user = User.get_by_email(get_jwt_identity())
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    shop = Shop.get_by_id(shop_id)
+    if not shop:
+        return jsonify({"error": "Shop not found"}), 404
+    if shop.id not in user.accessible_shop_ids():
+        return jsonify({"error": "Unauthorized access to shop"}), 403
+
+    results, applied = sync.sync_sales(shop, user, sales)
+    for transaction in applied:
+        record_sale(transaction)
+
+    counts = Counter(result['status'] for result in results)
+    return jsonify({
+        "results": results,
+        "applied": counts['applied'],
+        "duplicates": counts['duplicate'],
+        "conflicts": counts['conflict'],
+        "invalid": counts['invalid'],
+    }), 200
+
+
 # Delete item by barcode
 @product_bp.route('/delete-item/<barcode>', methods=['DELETE'])
 @jwt_required()
@@ -1,9 +1,10 @@
 from flask import Blueprint, request, jsonify
 from app.models import Shop
-from app.models import User
+from app.models import User, ref_id
 from bson import ObjectId
 from flask_jwt_extended import get_jwt_identity
 from flask_jwt_extended import jwt_required
+from app.utils import make_etag, not_modified
 
 shop_bp = Blueprint('shops', __name__)
 
@@ -11,7 +12,6 @@ shop_bp = Blueprint('shops', __name__)
 @jwt_required()
 def create_shop():
     data = request.get_json()
-    print(f"recieved data: {data}")
     shop_name = data.get('name')
     address = data.get('address')
     email = get_jwt_identity()
@@ -45,6 +45,13 @@ def get_shops_by_user():
         return jsonify({"error": "User not found"}), 404
 
     if user.role == "owner":
+        # Version stamps of every shop are enough to tell whether the list changed
+        versions = Shop.get_by_owner_id(user.id).only('data_version').as_pymongo()
+        etag = make_etag('shops', user.id, *[(v['_id'], v.get('data_version', 0)) for v in versions])
+        cached_response = not_modified(etag)
+        if cached_response:
+            return cached_response
+
         shops = Shop.get_by_owner_id(user.id)
         if not shops:
             return jsonify({"error": "No shops found for this owner"}), 404
@@ -52,12 +59,22 @@ def get_shops_by_user():
         shop_list = []
         for shop in shops:
             shop_list.append(shop.get_serialized())
-        return jsonify(shop_list), 200
+        response = jsonify(shop_list)
+        response.set_etag(etag)
+        return response, 200
     
     elif user.role == "employee":
         if not user.shop:
             return jsonify({"error": "No shop associated with this employee"}), 404
-        return jsonify([user.shop.get_serialized()]), 200
+        shop_id = ref_id(user._data.get('shop'))
+        etag = make_etag('shops', user.id, shop_id, Shop.get_data_version(shop_id))
+        cached_response = not_modified(etag)
+        if cached_response:
+            return cached_response
+
+        response = jsonify([user.shop.get_serialized()])
+        response.set_etag(etag)
+        return response, 200
     
     return jsonify({"error": "Invalid user role"}), 400
 
@@ -1,21 +1,25 @@
 from flask import Blueprint, jsonify, request
 from app.models import Transaction, Shop, User
+from app.db import replica_reads, reads
+from app.serialization import requested_fields
+from app.instrumentation import query_budget
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from bson import ObjectId
 from datetime import datetime
 
 transaction_bp = Blueprint('transactions', __name__)
 
+# `?fields=` may trim the page, e.g. fields=date,total to skip the payload arrays
+TRANSACTION_FIELDS = ('date', 'shop', 'user', 'transaction_type', 'payload', 'total')
+
 # Helper function to check if user has access to a shop
 def check_shop_access(user, shop_id):
-    if user.role == "owner":
-        return shop_id in [str(s.id) for s in user.shops]
-    elif user.role == "employee":
-        return user.shop and str(user.shop.id) == str(shop_id)
-    return False
+    return str(shop_id) in {str(s) for s in user.accessible_shop_ids()}
 
 @transaction_bp.route('/transactions', methods=['GET'])
 @jwt_required()
+@replica_reads
+@query_budget(5)
 def get_transactions():
     email = get_jwt_identity()
     user = User.get_by_email(email)
@@ -37,15 +41,11 @@ def get_transactions():
         query['shop'] = ObjectId(shop_id)
     else:
         # If no shop_id provided, get all shops user has access to
-        if user.role == "owner":
-            shop_ids = [s.id for s in user.shops]
+        if user.role in ("owner", "employee"):
+            shop_ids = user.accessible_shop_ids()
             if not shop_ids:
                 return jsonify([]), 200
             query['shop__in'] = shop_ids
-        elif user.role == "employee":
-            if not user.shop:
-                return jsonify([]), 200
-            query['shop'] = user.shop.id
     
     # Add transaction type filter if provided
     if transaction_type in ['sale', 'restock']:
@@ -63,18 +63,31 @@ def get_transactions():
     skip = (page - 1) * per_page
     
     # Get transactions ordered by date (most recent first)
-    transactions = Transaction.objects(**query).order_by('-date').skip(skip).limit(per_page)
-    total = Transaction.objects(**query).count()
-    
-    # Serialize transactions
+    fields = requested_fields(TRANSACTION_FIELDS)
+    # shop and user are always read to resolve their names
+    projection = set(fields) | {'shop', 'user'}
+    transactions = reads(Transaction)(**query).order_by('-date').skip(skip).limit(per_page).only(*projection)
+    total = reads(Transaction)(**query).count()
+    
+    # Serialize raw documents and resolve shop/user names with one query each
+    raw_transactions = list(transactions.as_pymongo())
+    shop_names = {
+        s['_id']: s.get('name')
+        for s in reads(Shop)(id__in={t['shop'] for t in raw_transactions}).only('name').as_pymongo()
+    }
+    user_names = {
+        u['_id']: u.get('name')
+        for u in reads(User)(id__in={t['user'] for t in raw_transactions}).only('name').as_pymongo()
+    }
+
     transactions_list = []
-    for transaction in transactions:
-        transaction_data = transaction.get_serialized()
+    for raw in raw_transactions:
+        transaction_data = Transaction.serialize(raw)
+        for field in projection.difference(fields):
+            transaction_data.pop(field, None)
         # Add shop name and user name for better context
-        shop = Shop.get_by_id(transaction.shop.id)
-        user = User.get_by_id(transaction.user.id)
-        transaction_data['shop_name'] = shop.name if shop else None
-        transaction_data['user_name'] = user.name if user else None
+        transaction_data['shop_name'] = shop_names.get(raw['shop'])
+        transaction_data['user_name'] = user_names.get(raw['user'])
         transactions_list.append(transaction_data)
     
     return jsonify({
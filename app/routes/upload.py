@@ -1,5 +1,6 @@
 from flask import Blueprint, request, jsonify
 import cloudinary.uploader
+from app.metrics import external_call
 
 upload_bp = Blueprint('upload', __name__)
 
@@ -11,7 +12,8 @@ def upload_image():
     image = request.files['image']
     
     # Upload to Cloudinary
-    result = cloudinary.uploader.upload(image)
+    with external_call('cloudinary'):
+        result = cloudinary.uploader.upload(image)
 
     # Return the secure URL
     return jsonify({
@@ -3,9 +3,14 @@ from app.models import User, Invitation, Shop  # Ensure Invitation is imported
 from flask_jwt_extended import get_jwt_identity, jwt_required
 import uuid
 import mongoengine as me  # Add this import to resolve the NameError
+from app.serialization import requested_fields, to_json_ready
 
 user_bp = Blueprint('users', __name__)
 
+# Employee listing fields; credentials and OTP state are never read
+EMPLOYEE_FIELDS = ('name', 'email', 'role')
+EMPLOYEE_OPTIONAL_FIELDS = EMPLOYEE_FIELDS + ('isVerified', 'canRestock')
+
 
 @user_bp.route('/user/<email>', methods=['GET'])
 @jwt_required()
@@ -19,20 +24,19 @@ def get_user_by_email(email):
 @user_bp.route('/users/<shop_id>', methods=['GET'])
 @jwt_required()
 def get_user_by_shop(shop_id):
-    users = User.get_employees_by_shop_id(shop_id)
+    fields = requested_fields(EMPLOYEE_FIELDS, EMPLOYEE_OPTIONAL_FIELDS)
+    users = list(User.get_employees_by_shop_id(shop_id).only(*fields).as_pymongo())
     if not users:
         return jsonify({"error": "User not found"}), 404
 
-    shop = Shop.get_by_id(shop_id)
+    shop = Shop.objects(id=shop_id).only('owner').as_pymongo().first()
+    owner = None
+    if shop and shop.get('owner'):
+        owner = User.objects(id=shop['owner']).exclude('password_hash', 'otp', 'otp_expiry').as_pymongo().first()
 
-    user_list = [shop.owner.get_serialized()] if shop and shop.owner else []
+    user_list = [User.serialize(owner)] if owner else []
     for user in users:
-        user_list.append({
-            "id": user.id,
-            "name": user.name,
-            "email": user.email,
-            "role": user.role
-        })
+        user_list.append(to_json_ready(user, fields=fields))
 
     return jsonify(user_list), 200
 
@@ -105,8 +109,8 @@ def join_shop():
     if not token:
         return jsonify({"error": "Invalid or missing token"}), 400
 
-    # Validate the token
-    invitation = Invitation.get_by_token(token)
+    # Validate and consume the token in one round trip; expired invitations never match
+    invitation = Invitation.consume(token)
     if not invitation:
         return jsonify({"error": "Invalid or expired invitation"}), 404
 
@@ -116,7 +120,4 @@ def join_shop():
         user.canRestock = invitation.canRestock
         user.save()
 
-    # Delete the invitation after use
-    invitation.delete()
-
     return jsonify({"message": "User successfully joined the shop"}), 201
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""
+Fast JSON path for API responses.
+
+List endpoints read raw documents with `as_pymongo()` (skipping mongoengine
+document construction), `to_json_ready` converts them to API dicts in a
+single pass, and `ORJSONProvider` encodes responses with orjson.
+"""
+import decimal
+from datetime import date, datetime
+
+import orjson
+from bson import ObjectId
+from flask import request
+from flask.json.provider import JSONProvider
+from werkzeug.http import http_date
+
+
+def _convert(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        # Same format Flask's default provider uses, so clients see no change
+        return http_date(value)
+    if isinstance(value, dict):
+        return {key: _convert(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_convert(item) for item in value]
+    return value
+
+
+def to_json_ready(doc, renames=None, exclude=(), fields=None):
+    """Convert a raw pymongo document into an API dict in one pass.
+
+    `_id` becomes `id`, `renames` maps stored keys to API keys, keys in
+    `exclude` are dropped and, when `fields` is given, every listed field is
+    present in the result (None when the document does not store it).
+    """
+    data = {}
+    if fields:
+        for field in fields:
+            data[renames.get(field, field) if renames else field] = None
+    for key, value in doc.items():
+        if key in exclude:
+            continue
+        if key == '_id':
+            key = 'id'
+        elif renames and key in renames:
+            key = renames[key]
+        data[key] = _convert(value)
+    return data
+
+
+def requested_fields(default, allowed=None, aliases=None):
+    """Stored field names to project for a list endpoint.
+
+    Honours a sparse fieldset passed as `?fields=a,b,c` (API names, limited
+    to `allowed`, defaulting to `default`); `aliases` maps API names to
+    stored names (e.g. shop_id -> shop). Unknown names are ignored.
+    """
+    aliases = aliases or {}
+    names = request.args.get('fields')
+    if names:
+        allowed = allowed or default
+        picked = [name.strip() for name in names.split(',')]
+        picked = [aliases.get(name, name) for name in picked if name in allowed]
+        if picked:
+            return tuple(dict.fromkeys(picked))
+    return tuple(aliases.get(name, name) for name in default)
+
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return http_date(obj)
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson"""
+
+    # Datetimes go through _default so the wire format matches Flask's provider
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=_default, option=self.option),
+            mimetype="application/json"
+        )
@@ -0,0 +1,256 @@
+"""
+Batched upload of sales recorded offline by a POS client.
+
+Every sale carries the client's own id for it and the time it happened.
+The batch is applied in the order it was sent:
+
+1. Sales whose client_id is already stored for the shop are reported as
+   duplicates. A retried upload is therefore safe, and a unique
+   (shop, client_id) index backs this up against concurrent uploads.
+2. The products and serialized items the batch touches are read with one
+   query each. Sales are then checked against that snapshot in order, so an
+   earlier sale can use up the stock a later one needs. Unknown products,
+   missing or already-sold barcodes and insufficient stock make a sale a
+   conflict; the rest of the batch still goes through.
+3. The transactions of the accepted sales are inserted with one
+   insert_many, keeping the original dates, so analytics place them on the
+   day they happened.
+4. Stock is taken with one conditional update per product, and serialized
+   items are claimed one by one. A sale that loses a race with an online
+   sale becomes a conflict: its other stock changes are undone and its
+   transaction is removed.
+"""
+import os
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from app.models import ASYNC_SIDE_EFFECTS, Item, Product, SaleItemPayload, Shop, Transaction
+
+MAX_SALES = int(os.getenv("SYNC_MAX_SALES", "500"))
+MAX_CLIENT_ID_LENGTH = 128
+# Device clocks drift; sales stamped slightly in the future are accepted
+CLOCK_SKEW = timedelta(minutes=5)
+DUPLICATE_KEY = 11000
+
+
+class SyncError(ValueError):
+    """A sale that cannot be applied; str(e) is reported to the client"""
+
+
+def parse_date(value):
+    try:
+        date = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise SyncError(f"Invalid date: {value}")
+    if date.tzinfo:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    if date > datetime.utcnow() + CLOCK_SKEW:
+        raise SyncError("Sale date is in the future")
+    return date
+
+
+def parse_sale(sale):
+    """Validate one uploaded sale; returns (client_id, date, [(product_id, quantity, price, barcodes)])"""
+    if not isinstance(sale, dict):
+        raise SyncError("Each sale must be an object")
+    client_id = sale.get('client_id')
+    if not isinstance(client_id, str) or not 0 < len(client_id) <= MAX_CLIENT_ID_LENGTH:
+        raise SyncError(f"client_id must be a string of 1 to {MAX_CLIENT_ID_LENGTH} characters")
+    cart = sale.get('cart')
+    if not isinstance(cart, list) or not cart:
+        raise SyncError("Cart must be a non-empty list")
+    lines = []
+    for cart_item in cart:
+        try:
+            product_id = ObjectId(str(cart_item.get('product_id')))
+            quantity = int(cart_item.get('quantity'))
+            price = float(cart_item.get('price'))
+        except Exception:
+            raise SyncError("Each cart item must have product_id, quantity, and price.")
+        if quantity <= 0 or price < 0:
+            raise SyncError("Quantity must be positive and price non-negative.")
+        barcodes = cart_item.get('barcodes') or []
+        lines.append((product_id, quantity, price, [str(b) for b in barcodes]))
+    return client_id, parse_date(sale.get('date')), lines
+
+
+class SaleSync:
+    def __init__(self, shop, user, sales):
+        self.shop = shop
+        self.user = user
+        self.sales = sales
+        self.results = [None] * len(sales)
+        # index -> (client_id, date, lines) for sales still to be applied
+        self.pending = {}
+        self.products = {}
+
+    def result(self, index, status, **fields):
+        client_id = self.sales[index].get('client_id') if isinstance(self.sales[index], dict) else None
+        self.results[index] = {'client_id': client_id, 'status': status, **fields}
+        self.pending.pop(index, None)
+
+    def run(self):
+        self.validate()
+        self.skip_already_synced()
+        items = self.load_snapshot()
+        transactions = self.plan(items)
+        self.insert_transactions(transactions)
+        self.take_bulk_stock(transactions)
+        self.take_serialized_items(items, transactions)
+        if transactions and not ASYNC_SIDE_EFFECTS:
+            Shop.bump_version(self.shop.id)
+        applied = []
+        for index in sorted(transactions):
+            self.result(index, 'applied', transaction_id=str(transactions[index].id))
+            applied.append(transactions[index])
+        return self.results, applied
+
+    def validate(self):
+        seen = {}
+        for index, sale in enumerate(self.sales):
+            try:
+                client_id, date, lines = parse_sale(sale)
+            except SyncError as e:
+                self.result(index, 'invalid', error=str(e))
+                continue
+            if client_id in seen:
+                self.result(index, 'duplicate', error=f"Same client_id as sale {seen[client_id]} of this batch")
+                continue
+            seen[client_id] = index
+            self.pending[index] = (client_id, date, lines)
+
+    def skip_already_synced(self):
+        by_client_id = {sale[0]: index for index, sale in self.pending.items()}
+        stored = Transaction.objects(shop=self.shop.id, client_id__in=list(by_client_id)).only('client_id').as_pymongo()
+        for doc in stored:
+            self.result(by_client_id[doc['client_id']], 'duplicate', transaction_id=str(doc['_id']))
+
+    def load_snapshot(self):
+        product_ids = {line[0] for _, _, lines in self.pending.values() for line in lines}
+        self.products = {
+            doc['_id']: doc for doc in Product.objects(id__in=list(product_ids), shop=self.shop.id)
+            .only('name', 'category', 'quantity', 'isSerialized').as_pymongo()
+        }
+        barcodes = {b for _, _, lines in self.pending.values() for line in lines for b in line[3]}
+        serialized = [pid for pid, doc in self.products.items() if doc.get('isSerialized')]
+        if not (barcodes and serialized):
+            return {}
+        return {
+            doc['barcode']: doc for doc in Item.objects(product__in=serialized, barcode__in=list(barcodes))
+            .only('barcode', 'product').as_pymongo()
+        }
+
+    def plan(self, items):
+        """Check the sales in order against the snapshot; returns {index: Transaction} for the accepted ones"""
+        products = self.products
+        available = {pid: doc.get('quantity', 0) for pid, doc in products.items() if not doc.get('isSerialized')}
+        unsold = set(items)
+        transactions = {}
+        for index, (client_id, date, lines) in list(self.pending.items()):
+            try:
+                taken, claimed, payload = Counter(), set(), []
+                for product_id, quantity, price, barcodes in lines:
+                    product = products.get(product_id)
+                    if not product:
+                        raise SyncError(f"Product with ID {product_id} not found in this shop.")
+                    if product.get('isSerialized'):
+                        if len(barcodes) != quantity:
+                            raise SyncError(f"Barcode information mismatch for serialized product {product['name']}. Expected {quantity} barcodes.")
+                        for barcode in barcodes:
+                            if barcode not in unsold or barcode in claimed or items[barcode]['product'] != product_id:
+                                raise SyncError(f"Item with barcode {barcode} not found, does not belong to product {product['name']}, or already sold.")
+                            claimed.add(barcode)
+                    else:
+                        if available[product_id] - taken[product_id] < quantity:
+                            raise SyncError(f"Insufficient stock for {product['name']}. Available: {available[product_id] - taken[product_id]}, Requested: {quantity}.")
+                        taken[product_id] += quantity
+                    payload.append(SaleItemPayload(
+                        product_id=str(product_id), name=product['name'], category=product.get('category') or '',
+                        quantity=quantity, price=price, isSerialized=bool(product.get('isSerialized')),
+                        barcodes=barcodes if product.get('isSerialized') else []
+                    ))
+            except SyncError as e:
+                self.result(index, 'conflict', error=str(e))
+                continue
+            for product_id, quantity in taken.items():
+                available[product_id] -= quantity
+            unsold -= claimed
+            transaction = Transaction(
+                id=ObjectId(), shop=self.shop, user=self.user, transaction_type="sale",
+                payload=payload, date=date, client_id=client_id
+            )
+            transaction.total = transaction.compute_total()
+            transactions[index] = transaction
+        return transactions
+
+    def insert_transactions(self, transactions):
+        if not transactions:
+            return
+        order = sorted(transactions)
+        try:
+            Transaction._get_collection().insert_many([transactions[i].to_mongo() for i in order], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] != DUPLICATE_KEY:
+                    raise
+                # Stored by a concurrent upload of the same sale since skip_already_synced
+                index = order[error['index']]
+                del transactions[index]
+                self.result(index, 'duplicate')
+
+    def reject(self, index, transactions, error, restock=()):
+        """Turn an accepted sale into a conflict, putting back the bulk stock it already took"""
+        for product_id, quantity in restock:
+            Product.adjust_quantity(product_id, quantity)
+        Transaction.objects(id=transactions.pop(index).id).delete()
+        self.result(index, 'conflict', error=error)
+
+    def bulk_lines(self, index):
+        """(product_id, quantity) of a sale's non-serialized products"""
+        _, _, lines = self.pending[index]
+        return [(line[0], line[1]) for line in lines if not self.products[line[0]].get('isSerialized')]
+
+    def serialized_barcodes(self, index):
+        _, _, lines = self.pending[index]
+        return [b for line in lines if self.products[line[0]].get('isSerialized') for b in line[3]]
+
+    def take_bulk_stock(self, transactions):
+        totals = defaultdict(int)
+        for index in transactions:
+            for product_id, quantity in self.bulk_lines(index):
+                totals[product_id] += quantity
+        # One conditional update per product; it fails only if an online sale took the stock meanwhile
+        short = {pid for pid, total in totals.items() if Product.adjust_quantity(pid, -total, only_if_available=True) is None}
+        for index in [i for i in sorted(transactions) if any(pid in short for pid, _ in self.bulk_lines(i))]:
+            self.reject(index, transactions, "Insufficient stock: it changed while the batch was being applied.",
+                        restock=[(pid, q) for pid, q in self.bulk_lines(index) if pid not in short])
+
+    def take_serialized_items(self, items, transactions):
+        sold = Counter()
+        collection = Item._get_collection()
+        for index in sorted(transactions):
+            deleted = []
+            for barcode in self.serialized_barcodes(index):
+                doc = collection.find_one_and_delete({'_id': items[barcode]['_id']})
+                if doc is None:
+                    break
+                deleted.append(doc)
+            else:
+                sold.update(doc['product'] for doc in deleted)
+                continue
+            if deleted:
+                collection.insert_many(deleted)
+            self.reject(index, transactions, f"Item with barcode {barcode} was sold while the batch was being applied.",
+                        restock=self.bulk_lines(index))
+        # Item.delete would adjust each product per item; here it is one update per product
+        if not ASYNC_SIDE_EFFECTS:
+            for product_id, count in sold.items():
+                Product.adjust_quantity(product_id, -count)
+
+
+def sync_sales(shop, user, sales):
+    """Apply a batch of offline sales; returns (per-sale results, applied transactions)"""
+    return SaleSync(shop, user, sales).run()
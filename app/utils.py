@@ -1,14 +1,34 @@
 import pyotp
 import smtplib
+import hashlib
+import logging
+from flask import request, make_response
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 import cloudinary.uploader
 
+from app.metrics import external_call
+
+logger = logging.getLogger(__name__)
+
 def upload_image_to_cloudinary(image_file):
-    result = cloudinary.uploader.upload(image_file)
+    with external_call('cloudinary'):
+        result = cloudinary.uploader.upload(image_file)
     return result["secure_url"]  # or result["url"] if you want non-secure
 
+def make_etag(*parts):
+    """Build an ETag from cheap version stamps instead of hashing the response body"""
+    return hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+
+def not_modified(etag):
+    """Return a 304 response if the client's If-None-Match already holds etag, else None"""
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+    return None
+
 def generate_otp_secret():
     
     return pyotp.random_base32()
@@ -33,15 +53,16 @@ def send_email(to_email, subject, body):
     msg.attach(MIMEText(body, "plain"))
 
     try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(from_email, from_password)
-        server.sendmail(from_email, to_email, msg.as_string())
-        server.quit()
+        with external_call('smtp'):
+            server = smtplib.SMTP(smtp_server, smtp_port)
+            server.starttls()
+            server.login(from_email, from_password)
+            server.sendmail(from_email, to_email, msg.as_string())
+            server.quit()
         return True
 
-    except Exception as e:
-        print(f"Failed to send email: {e}")
+    except Exception:
+        logger.exception("Failed to send email", extra={'subject': subject})
         return False
 
 
@@ -50,6 +71,6 @@ def send_password_reset_email(recipient_email, reset_link):
     body = f"Please click the following link to reset your password:\n{reset_link}\n\nIf you did not request this, please ignore this email.\nThis link will expire in 1 hour."
     
     if send_email(recipient_email, subject, body):
-        print(f"Password reset email sent to {recipient_email}")
+        logger.info("Password reset email sent")
     else:
-        print(f"Failed to send password reset email to {recipient_email}")
+        logger.warning("Password reset email could not be sent")
@@ -0,0 +1,265 @@
+"""
+Concurrency stress test for stock writes.
+
+Threads hammer the same few products through the Flask test client:
+- sales and restocks of bulk products
+- sales of serialized items, several threads at a time trying to sell
+  the same barcode, and restocks with new items
+- product edits, which use compare-and-swap saves
+
+Bulk products start with only a few units, so sales keep running into
+empty stock while other threads restock. Afterwards it checks the
+following, counted from the responses the threads received:
+- no product's quantity went below zero at any point (sampled during the
+  run, and checked at the end)
+- every bulk product's quantity equals its initial quantity plus what was
+  restocked minus what was sold
+- every barcode was sold at most once, in at most one transaction
+- every serialized product's quantity equals its number of items
+- the shop's stock counters match a recount
+
+    python -m benchmarks.concurrency_stress --threads 16 --seconds 20
+
+Needs a MongoDB at MONGO_URI and drops/uses the stockbench_stress
+database. Exits with status 1 on any mismatch.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+PASSWORD = "password123"
+# Low enough that concurrent sales compete for the last units
+INITIAL_QUANTITY = 10
+# Serialized sales pick from this many of the oldest unsold barcodes, so
+# threads regularly try to sell the same item at once
+CONTESTED_BARCODES = 4
+
+
+def setup(bulk_count, serialized_count, items_per_product):
+    from mongoengine.connection import get_db
+    from app.models import Item, Product, Shop, User
+    from app.passwords import hash_password
+
+    db = get_db()
+    db.client.drop_database(db.name)
+    owner = User(name="Stress Owner", email="stress@bench.test", password_hash=hash_password(PASSWORD), role="owner", isVerified=True).save()
+    shop = Shop(name="Stress Shop", address="Bench", owner=owner).save()
+    owner.shops = [shop]
+    owner.save()
+    bulk = [
+        Product(name=f"Bulk {i}", shop=shop, price=2.0, quantity=INITIAL_QUANTITY, threshold=50,
+                isSerialized=False, category="Stress").save()
+        for i in range(bulk_count)
+    ]
+    serialized, barcodes = [], []
+    for i in range(serialized_count):
+        product = Product(name=f"Serialized {i}", shop=shop, price=100.0, quantity=0, threshold=5,
+                          isSerialized=True, category="Stress").save()
+        serialized.append(product)
+        for _ in range(items_per_product):
+            barcode = uuid.uuid4().hex[:13]
+            Item(barcode=barcode, product=product).save()
+            barcodes.append((str(product.id), barcode))
+    return shop, bulk, serialized, barcodes
+
+
+class Worker(threading.Thread):
+    def __init__(self, app, token, shop_id, bulk_ids, serialized_ids, pool, pool_lock, deadline):
+        super().__init__(daemon=True)
+        self.client = app.test_client()
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.shop_id = shop_id
+        self.bulk_ids = bulk_ids
+        self.serialized_ids = serialized_ids
+        self.pool = pool
+        self.pool_lock = pool_lock
+        self.deadline = deadline
+        self.sold = Counter()
+        self.sold_barcodes = Counter()
+        self.restocked = Counter()
+        self.ops = Counter()
+        self.errors = []
+
+    def post(self, path, body):
+        return self.client.post(path, headers=self.headers, json={"shop_id": self.shop_id, **body})
+
+    def expect(self, name, response, *ok):
+        self.ops[f"{name} {response.status_code}"] += 1
+        if response.status_code not in ok:
+            self.errors.append(f"{name}: {response.status_code} {response.get_data(as_text=True)[:200]}")
+        return response.status_code
+
+    def sell_bulk(self):
+        product_id, quantity = random.choice(self.bulk_ids), random.randint(1, 3)
+        response = self.post("/products/sell", {"cart": [{"product_id": product_id, "quantity": quantity, "price": 2.0}]})
+        # 400: out of stock, a legitimate outcome
+        if self.expect("sell", response, 201, 400) == 201:
+            self.sold[product_id] += quantity
+
+    def restock_bulk(self):
+        product_id, quantity = random.choice(self.bulk_ids), random.randint(1, 5)
+        response = self.post("/products/restock", {"product_id": product_id, "cost_price": 1, "quantity": quantity})
+        if self.expect("restock", response, 201) == 201:
+            self.restocked[product_id] += quantity
+
+    def sell_serialized(self):
+        # Left in the pool until sold, so other threads may be selling it too
+        with self.pool_lock:
+            if not self.pool:
+                return
+            product_id, barcode = random.choice(self.pool[:CONTESTED_BARCODES])
+        response = self.post("/products/sell", {"cart": [
+            {"product_id": product_id, "quantity": 1, "price": 100.0, "barcodes": [barcode]}
+        ]})
+        # 400: another thread sold this item first
+        if self.expect("sell serialized", response, 201, 400) == 201:
+            self.sold_barcodes[barcode] += 1
+            with self.pool_lock:
+                if (product_id, barcode) in self.pool:
+                    self.pool.remove((product_id, barcode))
+
+    def restock_serialized(self):
+        product_id = random.choice(self.serialized_ids)
+        barcodes = [uuid.uuid4().hex[:13] for _ in range(random.randint(1, 3))]
+        response = self.post("/products/restock", {"product_id": product_id, "cost_price": 1, "barcodes": barcodes})
+        if self.expect("restock serialized", response, 201) == 201:
+            with self.pool_lock:
+                self.pool.extend((product_id, barcode) for barcode in barcodes)
+
+    def edit(self):
+        # Metadata-only edits race with every stock write on the same product
+        product_id = random.choice(self.bulk_ids + self.serialized_ids)
+        response = self.client.put(f"/products/update/{product_id}", headers=self.headers,
+                                   json={"description": uuid.uuid4().hex})
+        # 409: every retry lost the race, reported rather than overwriting stock
+        self.expect("edit", response, 200, 409)
+
+    def run(self):
+        operations = [self.sell_bulk] * 4 + [self.restock_bulk] * 2 + [self.sell_serialized] * 2 \
+            + [self.restock_serialized, self.edit, self.edit]
+        while time.monotonic() < self.deadline:
+            random.choice(operations)()
+
+
+class StockMonitor(threading.Thread):
+    """Samples every product's quantity during the run, keeping the lowest seen"""
+
+    def __init__(self, shop_id):
+        super().__init__(daemon=True)
+        self.shop_id = shop_id
+        self.lowest = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        from app.models import Product
+
+        while not self.stopped.wait(0.01):
+            for doc in Product.objects(shop=self.shop_id).only('name', 'quantity').as_pymongo():
+                self.lowest[doc['name']] = min(self.lowest.get(doc['name'], doc['quantity']), doc['quantity'])
+
+
+def verify(shop, bulk, serialized, workers, monitor):
+    from app.jobs import STOCK_COUNTERS, compute_stock_counters
+    from app.models import Item, Product, Shop, Transaction
+
+    sold, restocked, sold_barcodes = Counter(), Counter(), Counter()
+    for worker in workers:
+        sold.update(worker.sold)
+        restocked.update(worker.restocked)
+        sold_barcodes.update(worker.sold_barcodes)
+    recorded_barcodes = Counter(
+        barcode
+        for doc in Transaction.objects(shop=shop.id, transaction_type="sale").only('payload').as_pymongo()
+        for line in doc['payload']
+        for barcode in line.get('barcodes') or []
+    )
+
+    mismatches = [f"{name}: quantity went down to {lowest}" for name, lowest in sorted(monitor.lowest.items()) if lowest < 0]
+    for product in bulk + serialized:
+        actual = Product.objects(id=product.id).first().quantity
+        if actual < 0:
+            mismatches.append(f"{product.name}: final quantity {actual}")
+    for product in bulk:
+        pid = str(product.id)
+        expected = INITIAL_QUANTITY + restocked[pid] - sold[pid]
+        actual = Product.objects(id=product.id).first().quantity
+        if actual != expected:
+            mismatches.append(f"{product.name}: quantity {actual}, expected {expected}")
+    for barcode, count in sorted((sold_barcodes | recorded_barcodes).items()):
+        if count > 1:
+            mismatches.append(f"barcode {barcode}: {sold_barcodes[barcode]} successful sale(s), "
+                              f"{recorded_barcodes[barcode]} transaction(s)")
+    for product in serialized:
+        actual = Product.objects(id=product.id).first().quantity
+        expected = Item.objects(product=product.id).count()
+        if actual != expected:
+            mismatches.append(f"{product.name}: quantity {actual}, {expected} items")
+    stored = Shop.objects(id=shop.id).first()
+    actual_counters = compute_stock_counters([shop.id]).get(shop.id, {})
+    for field in STOCK_COUNTERS:
+        if abs(getattr(stored, field) - actual_counters.get(field, 0)) > 1e-6:
+            mismatches.append(f"shop {field}: stored {getattr(stored, field)}, actual {actual_counters.get(field, 0)}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--bulk-products', type=int, default=3, help='Few products, so threads collide often')
+    parser.add_argument('--serialized-products', type=int, default=2)
+    parser.add_argument('--items', type=int, default=200, help='Initial items per serialized product')
+    args = parser.parse_args()
+
+    os.environ["MONGO_URI"] = MONGO_URI
+    os.environ["mongodb_database_name"] = "stockbench_stress"
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+    os.environ.setdefault("secret_key", "stress-test-secret-key-of-32-bytes")
+
+    from app import create_app
+
+    app = create_app()
+    shop, bulk, serialized, barcodes = setup(args.bulk_products, args.serialized_products, args.items)
+    token = app.test_client().post("/auth/login", json={"email": "stress@bench.test", "password": PASSWORD}).json['access_token']
+
+    pool, pool_lock = list(barcodes), threading.Lock()
+    deadline = time.monotonic() + args.seconds
+    workers = [
+        Worker(app, token, str(shop.id), [str(p.id) for p in bulk], [str(p.id) for p in serialized],
+               pool, pool_lock, deadline)
+        for _ in range(args.threads)
+    ]
+    monitor = StockMonitor(shop.id)
+    monitor.start()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    monitor.stopped.set()
+    monitor.join()
+
+    ops = Counter()
+    for worker in workers:
+        ops.update(worker.ops)
+    print(f"{sum(ops.values())} requests from {args.threads} threads in {args.seconds:.0f}s")
+    for name, count in sorted(ops.items()):
+        print(f"  {name:<26} {count:>8}")
+
+    errors = [error for worker in workers for error in worker.errors]
+    mismatches = verify(shop, bulk, serialized, workers, monitor)
+    for line in errors[:20] + mismatches:
+        print(f"  ! {line}")
+    if errors or mismatches:
+        print(f"\n{len(errors)} unexpected response(s), {len(mismatches)} mismatch(es)")
+        sys.exit(1)
+    print("\nNo quantity went negative, no item was sold twice; all quantities and shop counters are exact")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Endpoint benchmarks with regression checks against a stored baseline.
+
+Runs the hot handlers (sell, restock, barcode scan, product and
+transaction listing, every analytics route and /forecast when it is
+registered) through the Flask test client against a seeded local
+MongoDB. Each data size runs in its own process and database. For every
+handler it reports p50/p99 latency and the median number of MongoDB
+commands a request issues on its own thread (from its Server-Timing
+header), so background threads do not skew it.
+
+    # seed stockbench_small / stockbench_medium, run, compare with the baseline
+    python -m benchmarks.endpoints --sizes small,medium --seed-data
+    # accept the current numbers as the new baseline
+    python -m benchmarks.endpoints --sizes small,medium --update-baseline
+
+Exits with status 1 when a handler's p50 regresses by more than
+--tolerance, or when its median query count exceeds the baseline (the
+median is deterministic, so any increase is flagged).
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+# app.instrumentation counts only the commands issued on the request's own
+# thread (driver housekeeping excluded) and reports them in Server-Timing
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_size(size, requests, warmup, cold):
+    """Benchmark every case against the stockbench_<size> database; returns {case: stats}"""
+    os.environ["MONGO_URI"] = MONGO_URI
+    os.environ["mongodb_database_name"] = f"stockbench_{size}"
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+    os.environ["INSTRUMENTATION_ENABLED"] = "true"
+
+    from app import create_app
+    from app.cache import response_cache
+    from app.models import Item, Product
+    from seed_database import PASSWORD, SHOP, make_id, employee_email
+
+    app = create_app()
+    client = app.test_client()
+    shop_id = make_id(SHOP, 0, 0)
+    token = client.post("/auth/login", json={"email": employee_email(0, 0), "password": PASSWORD}).json['access_token']
+    headers = {"Authorization": f"Bearer {token}"}
+
+    bulk = Product.objects(shop=shop_id, isSerialized=False).order_by('-quantity').first()
+    serialized_ids = Product.objects(shop=shop_id, isSerialized=True).distinct('id')
+    barcode = Item.objects(product__in=serialized_ids).first().barcode
+    # Enough stock for every sale the benchmark makes
+    Product.adjust_quantity(bulk.id, requests + warmup)
+
+    cases = {
+        'sell': lambda: client.post("/products/sell", headers=headers, json={
+            "shop_id": str(shop_id), "cart": [{"product_id": str(bulk.id), "quantity": 1, "price": bulk.price}]}),
+        'restock': lambda: client.post("/products/restock", headers=headers, json={
+            "shop_id": str(shop_id), "product_id": str(bulk.id), "cost_price": 1, "quantity": 1}),
+        'barcode': lambda: client.get(f"/products/barcode/{barcode}?shop_id={shop_id}", headers=headers),
+        'get_all_products': lambda: client.get(f"/products/?shop_id={shop_id}&per_page=50", headers=headers),
+        'get_transactions': lambda: client.get(f"/transactions?shop_id={shop_id}", headers=headers),
+        'product_sales': lambda: client.get(f"/analytics/product_sales/{shop_id}", headers=headers),
+    }
+    for route in ("summary_cards", "pie_chart/stock_by_category", "line_chart/monthly_sales",
+                  "bar_chart/daily_sales", "critical_products", "top_selling_products", "top_stocked_products"):
+        cases[route.split('/')[-1]] = lambda route=route: client.get(f"/analytics/{route}/{shop_id}", headers=headers)
+    if any(rule.rule == '/forecast' for rule in app.url_map.iter_rules()):
+        cases['forecast'] = lambda: client.post("/forecast", headers=headers, json={"store_id": "S001", "product_id": "P0001"})
+
+    results = {}
+    for name, call in cases.items():
+        latencies, queries = [], []
+        for i in range(warmup + requests):
+            if cold and hasattr(response_cache, 'clear'):
+                response_cache.clear()
+            start = time.perf_counter()
+            response = call()
+            elapsed = time.perf_counter() - start
+            if response.status_code >= 400:
+                raise SystemExit(f"{name} failed with {response.status_code}: {response.get_data(as_text=True)[:200]}")
+            if i >= warmup:
+                latencies.append(elapsed * 1000)
+                queries.append(int(SERVER_TIMING_QUERIES.search(response.headers['Server-Timing']).group(1)))
+        results[name] = {
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            # The median ignores the odd request that also refreshes the
+            # revocation list, so the count is stable from run to run
+            'queries': statistics.median_low(queries),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return human-readable regressions of results against baseline"""
+    regressions = []
+    for size, cases in results.items():
+        for name, stats in cases.items():
+            base = baseline.get(size, {}).get(name)
+            if not base:
+                continue
+            if stats['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+                regressions.append(f"{size}/{name}: p50 {stats['p50_ms']}ms > baseline {base['p50_ms']}ms")
+            if stats['queries'] > base['queries']:
+                regressions.append(f"{size}/{name}: {stats['queries']} queries > baseline {base['queries']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='small', help='Comma-separated seed_database scales')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--cold', action='store_true', help='Clear the response cache before every request')
+    parser.add_argument('--seed-data', action='store_true', help='(Re)seed each size before running')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative p50 slowdown')
+    parser.add_argument('--run-size', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size:
+        # Child process: one size per process because app.db connects on import
+        print(json.dumps(run_size(args.run_size, args.requests, args.warmup, args.cold)))
+        return
+
+    results = {}
+    for size in args.sizes.split(','):
+        if args.seed_data:
+            subprocess.run([sys.executable, 'seed_database.py', '--clear', '--scale', size,
+                            '--uri', MONGO_URI, '--db', f"stockbench_{size}"], check=True)
+        command = [sys.executable, '-m', 'benchmarks.endpoints', '--run-size', size,
+                   '--requests', str(args.requests), '--warmup', str(args.warmup)] + (['--cold'] if args.cold else [])
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results[size] = json.loads(output.strip().splitlines()[-1])
+
+    for size, cases in results.items():
+        print(f"\n[{size}]  {'handler':<22} {'p50 ms':>9} {'p99 ms':>9} {'queries':>8}")
+        for name, stats in cases.items():
+            print(f"{'':<{len(size) + 4}}{name:<22} {stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['queries']:>8}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --update-baseline to create one")
+        return
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+        print("\nRegressions:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+    print("\nNo regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
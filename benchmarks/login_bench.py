@@ -0,0 +1,68 @@
+"""
+Login throughput benchmark: password checks per second per core.
+
+Verifies passwords through app.passwords (the part of /auth/login that
+saturates the web tier) for each hash method given: first from a single
+caller, then from many concurrent callers, as in a login storm. The checks
+go through the same bounded pool, slot semaphore and PasswordCheckBusy path
+as the app, so the effect of PASSWORD_HASH_METHOD and
+PASSWORD_HASH_WORKERS can be compared before changing them. No database
+is needed.
+
+    python -m benchmarks.login_bench --seconds 3 --workers 4 \
+        --method scrypt:32768:8:1 --method scrypt:16384:8:1 --method pbkdf2:sha256:600000
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+DEFAULT_METHODS = ("scrypt:32768:8:1", "scrypt:16384:8:1", "pbkdf2:sha256:600000")
+PASSWORD = "correct horse battery staple"
+
+
+def checks_per_second(password_hash, seconds, callers):
+    """Verify from `callers` threads for about `seconds`; returns (checks/s, checks refused as busy)"""
+    from app.passwords import PasswordCheckBusy, verify_password
+
+    def work(deadline):
+        done = busy = 0
+        while time.perf_counter() < deadline:
+            try:
+                verify_password(password_hash, PASSWORD)
+                done += 1
+            except PasswordCheckBusy:
+                busy += 1
+        return done, busy
+
+    start = time.perf_counter()
+    deadline = start + seconds
+    with ThreadPoolExecutor(max_workers=callers) as pool:
+        results = list(pool.map(work, [deadline] * callers))
+    return sum(done for done, _ in results) / (time.perf_counter() - start), sum(busy for _, busy in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--method', action='append', help='Werkzeug hash method (repeatable)')
+    parser.add_argument('--seconds', type=float, default=3.0, help='Duration of each measurement')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='PASSWORD_HASH_WORKERS for the pool')
+    parser.add_argument('--callers', type=int, help='Concurrent callers for the parallel run (default: 4 per worker)')
+    args = parser.parse_args()
+
+    # app.passwords sizes its pool at import
+    os.environ["PASSWORD_HASH_WORKERS"] = str(args.workers)
+    callers = args.callers or args.workers * 4
+    cores = os.cpu_count() or 1
+    print(f"{'method':<24} {'1 caller/s':>12} {f'{callers} callers/s':>14} {'per core/s':>12} {'busy':>8}")
+    for method in args.method or DEFAULT_METHODS:
+        password_hash = generate_password_hash(PASSWORD, method=method)
+        single, _ = checks_per_second(password_hash, args.seconds, 1)
+        pooled, busy = checks_per_second(password_hash, args.seconds, callers)
+        print(f"{method:<24} {single:>12.1f} {pooled:>14.1f} {pooled / min(args.workers, cores):>12.1f} {busy:>8}")
+
+
+if __name__ == '__main__':
+    main()
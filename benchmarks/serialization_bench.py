@@ -0,0 +1,148 @@
+"""
+Micro-benchmark for the listing serialization path.
+
+Compares the previous path (build mongoengine documents, munge keys in
+Python, encode with Flask's default JSON provider) with the raw
+as_pymongo() + to_json_ready + orjson path, reporting objects/sec for
+product listings and transaction pages. No database is needed: the raw
+documents are generated in memory, which is exactly what as_pymongo() yields.
+
+    python -m benchmarks.serialization_bench --count 20000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from app.models import Product, Transaction
+from app.serialization import ORJSONProvider
+
+# Stored fields projected by the product listing
+LIST_FIELDS = ('name', 'shop', 'price', 'quantity', 'threshold', 'description', 'category', 'image_url')
+
+
+def make_products(count, rng):
+    shop_id = ObjectId()
+    return [
+        {
+            '_id': ObjectId(),
+            'name': f"Product {i}",
+            'shop': shop_id,
+            'price': round(rng.uniform(5, 500), 2),
+            'quantity': rng.randint(0, 200),
+            'threshold': rng.randint(5, 20),
+            'isSerialized': bool(i % 2),
+            'description': "A reasonably long product description " * 3,
+            'category': rng.choice(["Electronics", "Books", "Groceries"]),
+            'image_url': f"https://picsum.photos/seed/{i}/200/300",
+        }
+        for i in range(count)
+    ]
+
+
+def make_transactions(count, rng):
+    shop_id, user_id = ObjectId(), ObjectId()
+    now = datetime.utcnow()
+    return [
+        {
+            '_id': ObjectId(),
+            'date': now - timedelta(minutes=i),
+            'shop': shop_id,
+            'user': user_id,
+            'transaction_type': 'sale',
+            'payload': [
+                {
+                    '_cls': 'SaleItemPayload',
+                    'product_id': str(ObjectId()),
+                    'name': f"Product {j}",
+                    'category': "Electronics",
+                    'quantity': rng.randint(1, 5),
+                    'price': 10.0,
+                    'isSerialized': True,
+                    'barcodes': [str(rng.randint(10**12, 10**13)) for _ in range(3)],
+                }
+                for j in range(rng.randint(1, 6))
+            ],
+            'total': 100.0,
+        }
+        for i in range(count)
+    ]
+
+
+def legacy_products(raws):
+    products = [Product._from_son(raw) for raw in raws]
+    return [
+        {
+            "id": str(product.id),
+            "name": product.name,
+            "shop_id": str(product._data['shop'].id),
+            "price": product.price,
+            "quantity": product.quantity,
+            "threshold": product.threshold,
+            "description": product.description,
+            "category": product.category,
+            "image_url": product.image_url
+        }
+        for product in products
+    ]
+
+
+def legacy_transactions(raws):
+    result = []
+    for transaction in (Transaction._from_son(raw) for raw in raws):
+        data = transaction.to_mongo().to_dict()
+        data["id"] = str(data.pop("_id"))
+        data["shop"] = str(data["shop"])
+        data["user"] = str(data["user"])
+        result.append(data)
+    return result
+
+
+def fast_products(raws):
+    return [Product.serialize(raw, fields=LIST_FIELDS) for raw in raws]
+
+
+def fast_transactions(raws):
+    return [Transaction.serialize(raw) for raw in raws]
+
+
+def measure(label, build, encode, raws, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode(build(raws))
+        best = min(best, time.perf_counter() - start)
+    rate = len(raws) / best
+    print(f"{label:<28} {rate:>12,.0f} objects/sec")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    default_json = DefaultJSONProvider(app)
+    orjson_json = ORJSONProvider(app)
+
+    rng = random.Random(42)
+    products = make_products(args.count, rng)
+    transactions = make_transactions(args.count, rng)
+
+    for name, raws, legacy, fast in [
+        ("products", products, legacy_products, fast_products),
+        ("transactions", transactions, legacy_transactions, fast_transactions),
+    ]:
+        before = measure(f"{name} (before)", legacy, default_json.dumps, raws, args.repeat)
+        after = measure(f"{name} (after)", fast, orjson_json.dumps, raws, args.repeat)
+        print(f"{name:<28} {after / before:>11.1f}x\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Gunicorn settings:
+
+    gunicorn -c gunicorn.conf.py
+
+Workers share Prometheus metrics through PROMETHEUS_MULTIPROC_DIR (see
+app/metrics.py). It is set here, before any worker imports
+prometheus_client, emptied when the server starts and cleaned of a
+worker's live gauges when that worker exits.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+wsgi_app = "run:app"
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# Threaded workers: notification streams and long-polls hold a thread each
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "stocksmart-metrics"))
+
+
+def on_starting(server):
+    # Samples left by a previous run would otherwise be merged into this one's
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
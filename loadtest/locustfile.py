@@ -0,0 +1,122 @@
+"""
+Load scenario for a till-heavy day: scans, sales, restocks and dashboards.
+
+Each simulated user logs in as a seeded employee (see seed_database.py),
+discovers its shop's products and barcodes through the API, and then
+replays a traffic mix modelled on POS usage: mostly barcode scans and
+sales, product lists, dashboard refreshes and the occasional restock.
+
+    python seed_database.py --clear --scale medium
+    RATE_LIMIT_ENABLED=false gunicorn -w 4 -k gthread --threads 8 'app:create_app()'
+    SEED_SHOPS=100 locust -f loadtest/locustfile.py --host http://localhost:8000
+
+Disable rate limiting on the server under test: all simulated users log in
+from the same address.
+"""
+import os
+import random
+import uuid
+
+from locust import HttpUser, between, task
+
+SEED_SHOPS = int(os.getenv("SEED_SHOPS", "10"))
+EMPLOYEES_PER_SHOP = 3
+PASSWORD = "password123"
+EMAIL_DOMAIN = "seed.stocksmart.test"
+
+DASHBOARD_ROUTES = (
+    "summary_cards", "pie_chart/stock_by_category", "line_chart/monthly_sales",
+    "bar_chart/daily_sales", "critical_products", "top_selling_products", "top_stocked_products",
+)
+
+
+class ShopEmployee(HttpUser):
+    wait_time = between(0.5, 3)
+
+    def on_start(self):
+        shop_index = random.randrange(SEED_SHOPS)
+        email = f"employee{shop_index}-{random.randrange(EMPLOYEES_PER_SHOP)}@{EMAIL_DOMAIN}"
+        response = self.client.post("/auth/login", json={"email": email, "password": PASSWORD})
+        response.raise_for_status()
+        self.client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+
+        self.shop_id = self.client.get("/shops/shops").json()[0]["id"]
+        products = self.client.get(
+            "/products/", name="/products/",
+            params={"shop_id": self.shop_id, "per_page": 100, "fields": "name,price,quantity,isSerialized"}
+        ).json()["products"]
+        self.bulk_products = [p for p in products if not p.get("isSerialized")]
+        self.serialized_products = [p for p in products if p.get("isSerialized")]
+        self.barcodes = []
+        self.refill_barcodes()
+
+    def refill_barcodes(self):
+        for product in random.sample(self.serialized_products, min(5, len(self.serialized_products))):
+            response = self.client.get(f"/products/get-items/{product['id']}", name="/products/get-items/[id]")
+            if response.ok:
+                self.barcodes.extend((product["id"], item["barcode"]) for item in response.json())
+        random.shuffle(self.barcodes)
+
+    @task(30)
+    def scan(self):
+        if not self.barcodes:
+            return self.refill_barcodes()
+        _, barcode = random.choice(self.barcodes)
+        self.client.get(f"/products/barcode/{barcode}", params={"shop_id": self.shop_id},
+                        name="/products/barcode/[barcode]")
+
+    @task(20)
+    def sell_bulk(self):
+        if not self.bulk_products:
+            return
+        cart = [
+            {"product_id": p["id"], "quantity": 1, "price": p["price"]}
+            for p in random.sample(self.bulk_products, min(len(self.bulk_products), random.randint(1, 3)))
+        ]
+        with self.client.post("/products/sell", json={"shop_id": self.shop_id, "cart": cart},
+                              catch_response=True) as response:
+            # Running out of stock is an expected business outcome, not a failure
+            if response.status_code == 400 and "Insufficient stock" in response.text:
+                response.success()
+
+    @task(8)
+    def sell_serialized(self):
+        if not self.barcodes:
+            return self.refill_barcodes()
+        product_id, barcode = self.barcodes.pop()
+        price = next((p["price"] for p in self.serialized_products if p["id"] == product_id), 1.0)
+        cart = [{"product_id": product_id, "quantity": 1, "price": price, "barcodes": [barcode]}]
+        with self.client.post("/products/sell", json={"shop_id": self.shop_id, "cart": cart},
+                              catch_response=True) as response:
+            # Another simulated user may have sold the same item first
+            if response.status_code == 400 and "not found" in response.text:
+                response.success()
+
+    @task(10)
+    def list_products(self):
+        self.client.get("/products/", params={"shop_id": self.shop_id, "page": random.randint(1, 5)},
+                        name="/products/")
+
+    @task(10)
+    def dashboard(self):
+        for route in DASHBOARD_ROUTES:
+            self.client.get(f"/analytics/{route}/{self.shop_id}", name=f"/analytics/{route}/[shop]")
+
+    @task(3)
+    def transactions(self):
+        self.client.get("/transactions", params={"shop_id": self.shop_id}, name="/transactions")
+
+    @task(4)
+    def restock(self):
+        if self.serialized_products and random.random() < 0.5:
+            product = random.choice(self.serialized_products)
+            barcodes = [str(uuid.uuid4().int)[:13] for _ in range(random.randint(1, 5))]
+            body = {"shop_id": self.shop_id, "product_id": product["id"], "cost_price": 1, "barcodes": barcodes}
+            if self.client.post("/products/restock", json=body).ok:
+                self.barcodes.extend((product["id"], b) for b in barcodes)
+        elif self.bulk_products:
+            product = random.choice(self.bulk_products)
+            self.client.post("/products/restock", json={
+                "shop_id": self.shop_id, "product_id": product["id"], "cost_price": 1,
+                "quantity": random.randint(10, 50)
+            })